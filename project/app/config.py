@@ -21,11 +21,13 @@ config['tipfy'] = {
         'moe.users',
         'moe.paste',
         'moe.wiki',
+        'moe.search',
     ],
     # Set base paths for apps.
     'apps_entry_points': {
         'moe.paste': '/paste',
         'moe.wiki':  '/wiki',
+        'moe.search': '/search',
     },
 }
 
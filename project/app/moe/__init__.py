@@ -7,10 +7,19 @@ from tipfy import REQUIRED_VALUE
 #:   ``tipfy.REQUIRED_VALUE``.
 #: - ``analytics_code``: Google Analytics code.
 #: - `use_subdomain`: If `True`, loads app data based on current subdomain.
+#: - ``area_cache_time``: Time in seconds to keep areas cached in memory and
+#:   in memcache. Default is 600.
+#: - ``highlight_cache_size``: Maximum number of highlighted code blocks kept
+#:   in the memory of each instance. Default is 200.
+#: - ``highlight_cache_time``: Time in seconds to keep highlighted code in
+#:   memcache, or 0 to keep it until it is evicted. Default is 0.
 default_config = {
     'sitename':       REQUIRED_VALUE,
     'admin_email':    REQUIRED_VALUE,
     'analytics_code': None,
     'use_subdomain':  False,
     'menu_items_func': 'moe.base.handlers.get_menu_items',
+    'area_cache_time': 600,
+    'highlight_cache_size': 200,
+    'highlight_cache_time': 0,
 }
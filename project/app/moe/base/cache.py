@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+    moe.base.cache
+    ~~~~~~~~~~~~~~
+
+    In-process caching utilities.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import threading
+import time
+
+
+class LRUCache(object):
+    """An in-process cache that keeps up to ``max_size`` items, discarding
+    the least recently used ones first. Items can optionally expire.
+
+    Items live in the instance memory, so they are not shared between
+    instances: values that can change must be validated or expire.
+    """
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        """Removes all items."""
+        self._items = {}
+        # A circular doubly linked list of [prev, next, key, value, expires],
+        # from the least to the most recently used.
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+
+    def get(self, key, default=None):
+        """Returns a cached value.
+
+        :param key:
+            Cache key.
+        :param default:
+            Value returned if the key is not cached or expired.
+        :return:
+            The cached value or the default one.
+        """
+        self._lock.acquire()
+        try:
+            link = self._items.get(key)
+            if link is None:
+                return default
+
+            if link[4] and link[4] < time.time():
+                self._remove(link)
+                return default
+
+            # Move to the most recently used position.
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=0):
+        """Caches a value.
+
+        :param key:
+            Cache key.
+        :param value:
+            Value to be cached.
+        :param ttl:
+            Time in seconds to keep the value, or 0 to keep it until it is
+            discarded to make room for others.
+        :return:
+            ``None``.
+        """
+        if ttl:
+            expires = time.time() + ttl
+        else:
+            expires = None
+
+        self._lock.acquire()
+        try:
+            link = self._items.get(key)
+            if link is not None:
+                self._remove(link)
+
+            link = [None, None, key, value, expires]
+            self._items[key] = link
+            self._append(link)
+
+            while len(self._items) > self.max_size:
+                self._remove(self._root[1])
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        """Removes a cached value, if it exists."""
+        self._lock.acquire()
+        try:
+            link = self._items.get(key)
+            if link is not None:
+                self._remove(link)
+        finally:
+            self._lock.release()
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0], link[1] = last, self._root
+        last[1] = self._root[0] = link
+
+    def _unlink(self, link):
+        link[0][1], link[1][0] = link[1], link[0]
+
+    def _remove(self, link):
+        self._unlink(link)
+        del self._items[link[2]]
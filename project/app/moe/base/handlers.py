@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
 
 from tipfy import (abort, app, get_config, HTTPException, import_string, local,
@@ -9,7 +10,7 @@ from tipfy.ext import session
 from tipfy.ext import auth
 from tipfy.ext.auth import acl
 
-from moe.base.models import Area
+from moe.base.models import get_area
 
 
 class UserMiddleware(object):
@@ -46,9 +47,7 @@ class AreaRequestHandler(RequestHandler, jinja2.Jinja2Mixin, acl.AclMixin,
             # For now, only 404 is allowed.
             abort(404)
 
-        self.area = Area.get_by_key_name(area_name)
-        if self.area is None:
-            self.area = Area.get_or_insert(key_name=area_name, name=area_name)
+        self.area = get_area(area_name)
 
         # Get sitename from config or use host minus port as default
         # sitename.
@@ -64,12 +63,83 @@ class AreaRequestHandler(RequestHandler, jinja2.Jinja2Mixin, acl.AclMixin,
             'apps_installed': get_config('tipfy', 'apps_installed'),
         }
 
+    #: Validators for the response set by :meth:`check_not_modified`.
+    validators = None
+
     def render_response(self, filename, **values):
         # System messages.
         self.request.context['messages'] = self.messages
 
-        return super(AreaRequestHandler, self).render_response(filename,
+        response = super(AreaRequestHandler, self).render_response(filename,
             **values)
+        return self.set_validators(response)
+
+    def check_not_modified(self, key, last_modified=None, private=True):
+        """Sets the validators for the response and checks if the client
+        already has a current copy of it. Call it before doing any expensive
+        work to build the response.
+
+        :param key:
+            A string that changes whenever the resource changes. Used to
+            build the ETag.
+        :param last_modified:
+            A ``datetime`` with the last modification of the resource.
+        :param private:
+            ``True`` if the response depends on the current user. Then the
+            ETag also depends on the user and locale, ``If-Modified-Since``
+            is ignored and the response is not stored by shared caches.
+        :return:
+            A "304 Not Modified" response if the client copy is current, or
+            ``None`` if the response must be built.
+        """
+        if private:
+            if self.messages:
+                # Messages must be displayed, so always build the response.
+                return None
+
+            user = self.current_user
+            key = u'%s|%s|%s' % (key, user and str(user.key()) or '',
+                i18n.get_locale())
+
+        etag = hashlib.md5(unicode(key).encode('utf-8')).hexdigest()
+        if last_modified is not None:
+            last_modified = last_modified.replace(microsecond=0)
+
+        self.validators = (etag, last_modified, private)
+
+        if self.request.if_none_match:
+            # ETags take precedence over dates.
+            not_modified = etag in self.request.if_none_match
+        elif self.request.if_modified_since and last_modified is not None \
+            and not private:
+            not_modified = last_modified <= self.request.if_modified_since
+        else:
+            not_modified = False
+
+        if not_modified:
+            return self.set_validators(Response(status=304))
+
+    def set_validators(self, response):
+        """Adds the validators set by :meth:`check_not_modified` to a
+        response.
+
+        :param response:
+            A ``Response`` object.
+        :return:
+            The same response.
+        """
+        if self.validators is not None:
+            etag, last_modified, private = self.validators
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+
+            if private:
+                response.headers['Cache-Control'] = 'private, max-age=0'
+            else:
+                response.headers['Cache-Control'] = 'public, max-age=0'
+
+        return response
 
     def set_form_error(self, body=None, title=None):
         """Adds a form error message.
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+    moe.base.highlighting
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Syntax highlighting shared by the wiki and the pastebin.
+
+    Lexers and formatters are created on first use and reused: Pygments
+    loads lexer and style modules only when they are needed.
+
+    Highlighted code is cached by a hash of the lexer name, the formatter
+    options and the code, in the instance memory and in memcache, so code
+    that didn't change is not highlighted again.
+
+    Very large code can be highlighted in chunks of lines, to keep the
+    memory used by Pygments bounded.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import hashlib
+
+import pygments
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
+
+from google.appengine.api import memcache
+
+from tipfy import get_config
+
+from moe.base.cache import LRUCache
+
+#: Prefix for memcache keys of highlighted code.
+CACHE_PREFIX = 'moe.highlight:'
+
+#: Highlighted code longer than this is not cached.
+MAX_CACHED_SIZE = 100000
+
+#: Maximum number of lexers kept by :func:`get_lexer`.
+MAX_LEXERS = 100
+
+#: In-process cache shared by all requests in this instance.
+_local_cache = None
+
+#: Lexers by name and formatters by options, shared by all requests.
+_lexers = {}
+_formatters = {}
+
+
+def get_local_cache():
+    global _local_cache
+    if _local_cache is None:
+        _local_cache = LRUCache(get_config('moe', 'highlight_cache_size'))
+
+    return _local_cache
+
+
+def highlight_code(code, language, **options):
+    """Highlights code to HTML, using cached results when possible.
+
+    :param code:
+        The code to be highlighted.
+    :param language:
+        Name of the Pygments lexer. Unknown names are highlighted as text.
+    :param options:
+        Options for the ``HtmlFormatter``.
+    :return:
+        The highlighted code.
+    """
+    cache_key = get_cache_key(code, language, options)
+    local_cache = get_local_cache()
+    html = local_cache.get(cache_key)
+    if html is not None:
+        return html
+
+    html = memcache.get(cache_key)
+    if html is None:
+        html = pygments.highlight(code, get_lexer(language),
+            get_formatter(**options))
+        if len(html) > MAX_CACHED_SIZE:
+            return html
+
+        memcache.set(cache_key, html,
+            time=get_config('moe', 'highlight_cache_time'))
+
+    local_cache.set(cache_key, html)
+    return html
+
+
+def highlight_chunks(code, language, chunk_lines=1000, first_line=1,
+    **options):
+    """Highlights code to HTML a chunk of lines at a time. Results are not
+    cached. Each chunk is lexed separately, so constructs spanning chunks,
+    like long multi-line strings, may be highlighted differently than in a
+    single pass.
+
+    Chunks end after a newline and are lexed keeping their leading and
+    trailing blank lines, so that each chunk has exactly ``chunk_lines``
+    lines and line numbers don't drift.
+
+    :param code:
+        The code to be highlighted. Every line should end with a newline:
+        a blank last line without one is not displayed.
+    :param language:
+        Name of the Pygments lexer. Unknown names are highlighted as text.
+    :param chunk_lines:
+        Number of lines highlighted at a time.
+    :param first_line:
+        Line number of the first line of code.
+    :param options:
+        Options for the ``HtmlFormatter``. Line numbers continue from one
+        chunk to the next.
+    :return:
+        A generator with the highlighted HTML of each chunk.
+    """
+    lexer = get_lexer(language, stripnl=False)
+    line = first_line
+    start = 0
+    while start < len(code):
+        end = start
+        for i in range(chunk_lines):
+            end = code.find(u'\n', end) + 1
+            if not end:
+                end = len(code)
+                break
+
+        # A new formatter for each chunk: they differ by the first line
+        # number, so they can't be reused.
+        formatter = HtmlFormatter(linenostart=line, **options)
+        yield pygments.highlight(code[start:end], lexer, formatter)
+        line += chunk_lines
+        start = end
+
+
+def get_lexer(language, **options):
+    """Returns the lexer for a language and a combination of options,
+    loading it on first use. Unknown languages use the text lexer.
+
+    :param language:
+        Name of the Pygments lexer.
+    :param options:
+        Options for the lexer, such as ``stripnl``.
+    :return:
+        A lexer instance, shared by all callers.
+    """
+    key = (language,) + tuple(sorted(options.items()))
+    lexer = _lexers.get(key)
+    if lexer is None:
+        try:
+            lexer = get_lexer_by_name(language, **options)
+        except ClassNotFound:
+            lexer = get_lexer('text', **options)
+
+        if len(_lexers) < MAX_LEXERS:
+            _lexers[key] = lexer
+
+    return lexer
+
+
+def get_formatter(**options):
+    """Returns an HTML formatter for a combination of options, such as style
+    and line numbers, creating it on first use.
+
+    :param options:
+        Options for the ``HtmlFormatter``.
+    :return:
+        A formatter instance, shared by all callers.
+    """
+    key = tuple(sorted(options.items()))
+    formatter = _formatters.get(key)
+    if formatter is None:
+        formatter = _formatters[key] = HtmlFormatter(**options)
+
+    return formatter
+
+
+def get_cache_key(code, language, options):
+    key = hashlib.md5((u'%s|%r|' % (language, sorted(options.items())) +
+        code).encode('utf-8'))
+    return CACHE_PREFIX + key.hexdigest()
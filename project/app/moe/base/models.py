@@ -1,5 +1,87 @@
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
+from tipfy import get_config
+
+from moe.base.cache import LRUCache
+
+#: Prefix for memcache keys storing areas.
+AREA_CACHE_PREFIX = 'moe.area:'
+
+#: Areas cached in the instance memory.
+_areas = LRUCache(max_size=100)
+_areas_loaded = False
+
+
 class Area(db.Model):
     name = db.StringProperty()
     owner = db.StringProperty()
+
+    def put(self, *args, **kwargs):
+        key = super(Area, self).put(*args, **kwargs)
+        invalidate_area(key.name())
+        return key
+
+
+def get_area(name):
+    """Returns an area by name, creating it if it doesn't exist. Areas are
+    cached in the instance memory and in memcache for ``area_cache_time``
+    seconds. All areas are loaded with a single query on the first call.
+
+    :param name:
+        Area name, which is also its key name.
+    :return:
+        An :class:`Area` entity.
+    """
+    if not _areas_loaded:
+        load_areas()
+
+    area = _areas.get(name)
+    if area is not None:
+        return area
+
+    cache_time = get_config('moe', 'area_cache_time')
+    area = memcache.get(AREA_CACHE_PREFIX + name)
+    if area is None:
+        area = Area.get_by_key_name(name)
+        if area is None:
+            area = Area.get_or_insert(key_name=name, name=name)
+
+        memcache.set(AREA_CACHE_PREFIX + name, area, time=cache_time)
+
+    _areas.set(name, area, ttl=cache_time)
+    return area
+
+
+def load_areas(limit=100):
+    """Loads all areas with a single query and caches them.
+
+    :param limit:
+        Maximum number of areas to load.
+    :return:
+        ``None``.
+    """
+    global _areas_loaded
+    _areas_loaded = True
+
+    cache_time = get_config('moe', 'area_cache_time')
+    areas = dict((area.key().name(), area) for area in
+        Area.all().fetch(limit))
+
+    for name, area in areas.iteritems():
+        _areas.set(name, area, ttl=cache_time)
+
+    memcache.set_multi(areas, key_prefix=AREA_CACHE_PREFIX, time=cache_time)
+
+
+def invalidate_area(name):
+    """Removes an area from the cache of this instance and from memcache.
+    Other instances keep their copy until it expires.
+
+    :param name:
+        Area name.
+    :return:
+        ``None``.
+    """
+    _areas.delete(name)
+    memcache.delete(AREA_CACHE_PREFIX + name)
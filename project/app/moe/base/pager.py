@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+    moe.base.pager
+    ~~~~~~~~~~~~~~
+
+    Cursor based pager for datastore queries.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import hashlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+#: Prefix for memcache keys storing the cursor of previous pages.
+CACHE_PREFIX = 'moe.pager.'
+
+#: Time in seconds to keep the cursor of previous pages.
+CACHE_TIME = 3600
+
+
+class Pager(object):
+    """Pages through the results of a query using cursors.
+
+    Each page fetches one result more than needed to find out if there's a
+    next page. That extra result is the first one of the next page, so the
+    cursor for the next page carries its key: the next page loads it with a
+    get (or not at all, for keys only queries) and continues the query right
+    after it.
+
+    The cursor of each page is cached with the cursor of the page before it,
+    to allow paging backwards.
+
+    Cursors come from requests, so the key they carry is only used if it has
+    the kind of the query and its entity still matches the query filters.
+    Invalid cursors return the first page.
+    """
+    def __init__(self, query, limit=20, prefetch=None, match=None):
+        """
+        :param query:
+            A ``db.Query`` to page through.
+        :param limit:
+            Number of results per page.
+        :param prefetch:
+            Optional callable that receives the list of results of a page and
+            returns the list to be used instead. Used to batch load entities
+            referenced by the results.
+        :param match:
+            Optional callable that receives an entity and returns ``True``
+            if it matches the query filters. Used to check the first result
+            carried by a cursor; without it, the key carried by a cursor is
+            ignored.
+        """
+        self.query = query
+        self.limit = limit
+        self.prefetch = prefetch
+        self.match = match
+        self.entities = []
+        self.cursor = self.next_cursor = self.prev_cursor = None
+
+    @property
+    def is_first_page(self):
+        return not self.cursor
+
+    def fetch(self, cursor=None):
+        """Fetches a page of results.
+
+        :param cursor:
+            A cursor returned by a previous call, or ``None`` to fetch the
+            first page.
+        :return:
+            A tuple ``(entities, next_cursor)``. ``next_cursor`` is ``None``
+            if there are no more results. After this call, ``prev_cursor`` is
+            set to the cursor of the previous page if it is known: an empty
+            string means the first page.
+        """
+        first = None
+        entities = None
+        if cursor:
+            try:
+                query_cursor, first_key = split_cursor(cursor)
+                self.query.with_cursor(query_cursor)
+                if first_key:
+                    first = self.get_first(db.Key(first_key))
+
+                limit = self.limit + 1
+                if first is not None:
+                    limit -= 1
+
+                entities = self.query.fetch(limit)
+            except (db.BadArgumentError, db.BadKeyError, db.BadRequestError,
+                db.BadValueError):
+                # Invalid cursor: start from the first page.
+                self.query.with_cursor(None)
+                cursor = first = None
+
+        self.cursor = cursor
+        if cursor:
+            self.prev_cursor = memcache.get(get_cache_key(cursor))
+        else:
+            entities = self.query.fetch(self.limit + 1)
+
+        if first is not None:
+            entities.insert(0, first)
+
+        self.next_cursor = None
+        if len(entities) > self.limit:
+            # The extra result is the first one of the next page.
+            last = entities.pop()
+            if not isinstance(last, db.Key):
+                last = last.key()
+
+            self.next_cursor = join_cursor(self.query.cursor(), last)
+            memcache.set(get_cache_key(self.next_cursor), cursor or '',
+                time=CACHE_TIME)
+
+        if self.prefetch is not None and entities:
+            entities = self.prefetch(entities)
+
+        self.entities = entities
+        return entities, self.next_cursor
+
+    def get_first(self, key):
+        """Returns the first result carried by a cursor, or ``None`` if it
+        doesn't belong to the query results.
+
+        :param key:
+            The key carried by the cursor.
+        :return:
+            The entity, or its key for keys only queries.
+        """
+        if self.match is None or key.kind() != self.query._model_class.kind():
+            return None
+
+        entity = db.get(key)
+        if entity is None or not self.match(entity):
+            return None
+
+        if self.query.is_keys_only():
+            return key
+
+        return entity
+
+
+def join_cursor(query_cursor, key):
+    """Builds a pager cursor from a query cursor and the key of the first
+    result of the page.
+    """
+    return '%s:%s' % (query_cursor, str(key))
+
+
+def split_cursor(cursor):
+    """Returns a tuple ``(query_cursor, key)`` from a pager cursor. Plain
+    query cursors are also accepted, and return ``None`` as key.
+    """
+    parts = cursor.split(':', 1)
+    if len(parts) == 1:
+        return cursor, None
+
+    return tuple(parts)
+
+
+def get_cache_key(cursor):
+    return CACHE_PREFIX + hashlib.md5(cursor.encode('utf-8')).hexdigest()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    moe.base.properties
+    ~~~~~~~~~~~~~~~~~~~
+
+    Custom datastore properties.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import zlib
+
+from google.appengine.ext import db
+
+
+class CompressedBlob(db.Blob):
+    """Compressed text, as loaded from the datastore."""
+
+
+class CompressedTextProperty(db.UnindexedProperty):
+    """A text property stored compressed with zlib. Values are only
+    decompressed when they are accessed, and stored values that were not
+    changed are saved again without recompressing them.
+
+    Values stored by a ``db.TextProperty`` are read as they are, and are
+    compressed the next time the entity is saved, so a ``TextProperty`` can
+    be replaced by this one without converting existing entities first.
+    """
+    data_type = db.Text
+
+    def __init__(self, verbose_name=None, level=6, **kwargs):
+        """
+        :param verbose_name:
+            User friendly name of property.
+        :param level:
+            zlib compression level, from 1 (fastest) to 9 (smallest).
+        """
+        super(CompressedTextProperty, self).__init__(verbose_name, **kwargs)
+        self.level = level
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None:
+            return self
+
+        value = self.get_raw_value(model_instance)
+        if isinstance(value, CompressedBlob):
+            value = db.Text(zlib.decompress(value).decode('utf-8'))
+            setattr(model_instance, self._attr_name(), value)
+
+        return value
+
+    def get_raw_value(self, model_instance):
+        """Returns the value without decompressing it."""
+        return getattr(model_instance, self._attr_name(), None)
+
+    def get_value_for_datastore(self, model_instance):
+        value = self.get_raw_value(model_instance)
+        if value is None or isinstance(value, CompressedBlob):
+            return value
+
+        return db.Blob(zlib.compress(value.encode('utf-8'), self.level))
+
+    def make_value_from_datastore(self, value):
+        if isinstance(value, db.Blob):
+            return CompressedBlob(value)
+
+        return value
+
+    def validate(self, value):
+        if isinstance(value, CompressedBlob):
+            return value
+
+        return super(CompressedTextProperty, self).validate(value)
+
+
+def is_compressed(entity):
+    """Checks if all compressed text properties of an entity are stored
+    compressed.
+
+    :param entity:
+        A ``db.Model`` instance.
+    :return:
+        ``False`` if any value was stored uncompressed, ``True`` otherwise.
+    """
+    for prop in entity.properties().itervalues():
+        if isinstance(prop, CompressedTextProperty) and \
+            isinstance(prop.get_raw_value(entity), db.Text):
+            return False
+
+    return True
+
+
+def compress_entities(query, cursor=None, limit=50):
+    """Saves again a batch of entities that have text stored uncompressed,
+    so that it is compressed. Each entity is saved in a transaction, to not
+    overwrite concurrent changes.
+
+    :param query:
+        A ``db.Query`` for the entities to convert.
+    :param cursor:
+        A cursor returned by the previous batch, or ``None`` to start.
+    :param limit:
+        Number of entities checked by this batch.
+    :return:
+        A tuple ``(cursor, count)`` with the cursor for the next batch, or
+        ``None`` if all entities were checked, and the number of entities
+        that were converted.
+    """
+    if cursor is not None:
+        query.with_cursor(cursor)
+
+    entities = query.fetch(limit)
+    count = 0
+    for entity in entities:
+        if not is_compressed(entity):
+            db.run_in_transaction(compress_entity, entity.key())
+            count += 1
+
+    if len(entities) == limit:
+        return query.cursor(), count
+
+    return None, count
+
+
+def compress_entity(key):
+    """Saves again an entity if it has text stored uncompressed."""
+    entity = db.get(key)
+    if entity is not None and not is_compressed(entity):
+        entity.put()
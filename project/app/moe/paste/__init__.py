@@ -1 +1,33 @@
-
+# -*- coding: utf-8 -*-
+#: Default configuration values for this module. Keys are:
+#: - ``highlight_task_size``: Pastes with more characters than this are saved
+#:   right away and highlighted by a background task; until it is done they
+#:   are displayed as plain text. Use 0 to always highlight while saving.
+#:   Default is 50000.
+#: - ``highlight_chunk_lines``: Number of lines highlighted at a time by the
+#:   background task. Default is 1000.
+#: - ``max_highlighted_size``: Maximum size of the highlighted HTML stored
+#:   for a paste or a chunk of a paste. Larger ones are displayed as plain
+#:   text. Default is 800000.
+#: - ``chunk_lines``: Pastes with more lines than this are stored in chunks
+#:   of this number of lines, so that line ranges can be loaded on their
+#:   own. Default is 1000.
+#: - ``chunk_size``: Pastes with more characters than this are also stored
+#:   in chunks, with fewer lines per chunk so that chunks have about this
+#:   size. Pastes stored in chunks are displayed progressively and only get
+#:   their code in the edit form on demand. Default is 100000.
+#: - ``view_initial_lines``: Number of lines of a paste stored in chunks
+#:   sent with the page; the next ones are loaded by the browser as the
+#:   page is scrolled. Default is 1000.
+#: - ``view_initial_size``: Maximum number of characters of a paste stored
+#:   in chunks sent with the page. At least one chunk is sent. Default is
+#:   100000.
+default_config = {
+    'highlight_task_size':   50000,
+    'highlight_chunk_lines': 1000,
+    'max_highlighted_size':  800000,
+    'chunk_lines':           1000,
+    'chunk_size':            100000,
+    'view_initial_lines':    1000,
+    'view_initial_size':     100000,
+}
@@ -8,13 +8,26 @@
     :copyright: 2010 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
-from tipfy import NotFound, request, Response, url_for, redirect_to
+import datetime
+
+from django.utils import simplejson
+
+from google.appengine.ext import db
+
+from tipfy import (abort, get_config, NotFound, request, Response, url_for,
+    redirect_to)
 from tipfy.ext.i18n import _
+from tipfy.ext.auth.model import User
+from tipfy.ext.jinja2 import render_template
 
 from moe.base.handlers import AreaRequestHandler
+from moe.base.properties import compress_entities
 
-from moe.paste.models import Paste, PasteForm
-from moe.paste.highlighting import highlight
+from moe.paste.models import (delete_expired_pastes, Paste, PasteChunk,
+    PasteContent, PasteForm, paste_list_pager, save_paste, update_content)
+from moe.paste.highlighting import (get_style, get_stylesheet,
+    get_stylesheet_url, highlight, highlight_large, is_valid_style)
+from moe.search.models import add_index_task, index_document
 
 
 class PasteBaseHandler(AreaRequestHandler):
@@ -35,10 +48,25 @@ class PasteBaseHandler(AreaRequestHandler):
     def add_breadcrumb(self, endpoint, text, **kwargs):
         self.breadcrumbs.append(self.get_breadcrumb(endpoint, text, **kwargs))
 
+    def get_paste(self, paste_id):
+        """Returns a paste with its content. Raises ``NotFound`` if it
+        doesn't exist or expired, even if it was not deleted yet.
+        """
+        paste = None
+        if paste_id:
+            paste = Paste.get_by_id(paste_id)
+
+        if not paste or paste.is_expired or not paste.content:
+            raise NotFound()
+
+        return paste
+
     def render_response(self, filename, **values):
         self.request.context['breadcrumbs'] = [
             self.get_breadcrumb('home/index', _('Home')),
             self.get_breadcrumb('paste/index', _('Paste'))] + self.breadcrumbs
+        self.request.context['style_url'] = get_stylesheet_url(
+            get_style(name_only=True), self.area.name)
 
         return super(PasteBaseHandler, self).render_response(filename, **values)
 
@@ -60,22 +88,33 @@ class PasteNewHandler(PasteBaseHandler):
         if self.form.validate():
             if self.current_user:
                 user_key = str(self.current_user.key())
+                username = self.current_user.username
             else:
-                user_key = None
+                user_key = username = None
 
             language_code = request.form.get('language')
             code_raw = request.form.get('code', u'')
-            code = highlight(code_raw, language_code)
-
-            values = {
-                'area_key': str(self.area.key()),
-                'user_key': user_key,
-                'code_raw': code_raw,
-                'code':     code,
-                'language': language_code,
-            }
-            paste = Paste(**values)
-            paste.put()
+
+            # Large pastes are highlighted and indexed by a task.
+            task_size = get_config('moe.paste', 'highlight_task_size')
+            in_background = task_size and len(code_raw) > task_size
+
+            if in_background:
+                highlight_func = None
+            else:
+                highlight_func = highlight
+
+            paste = save_paste(str(self.area.key()), user_key,
+                code_raw, language_code, highlight_func=highlight_func,
+                username=username, expiry=request.form.get('expiry'))
+            if in_background or paste.content.highlight_pending:
+                from google.appengine.api.labs import taskqueue
+                url = url_for('paste/highlight', paste_id=paste.id,
+                    area_name=self.area.name)
+                taskqueue.add(url=url)
+            else:
+                add_index_task(self.area, 'paste', str(paste.id))
+
             self.set_message('success', _('The paste was saved.'), flash=True)
 
             return redirect_to('paste/view', paste_id=paste.id,
@@ -87,46 +126,329 @@ class PasteNewHandler(PasteBaseHandler):
 
 
 class PasteViewHandler(PasteBaseHandler):
-    """Displays a paste."""
+    """Displays a paste. Pastes stored in chunks are displayed progressively:
+    the page has the first ``view_initial_lines`` lines, up to
+    ``view_initial_size`` characters, and the next chunks are loaded from
+    :class:`PasteViewBlockHandler`. The code of pastes stored in chunks, or
+    larger than ``chunk_size``, is only loaded in the edit form when the user
+    asks for it.
+    """
     def get(self, **kwargs):
-        paste_id = kwargs.pop('paste_id', None)
-        if not paste_id:
-            raise NotFound()
+        paste = self.get_paste(kwargs.pop('paste_id', None))
 
-        paste = Paste.get_by_id(paste_id)
-        if not paste:
-            raise NotFound()
+        # The content changes when it is highlighted in background.
+        updated = max(paste.updated, paste.content.updated)
+        response = self.check_not_modified('%s|%s|%s' % (paste.id,
+            updated.isoformat(), get_style(name_only=True)),
+            last_modified=updated)
+        if response is not None:
+            return response
 
         self.add_breadcrumb('paste/view',
             _('Paste #%(paste_id)s', paste_id=paste.id),
             paste_id=paste.id)
-        form = PasteForm(code=paste.code_raw, language=paste.language)
+        content = paste.content
+        next_block_url = None
+        if content.chunk_count:
+            chunks = content.get_chunks(1,
+                get_config('moe.paste', 'view_initial_lines'))
+            max_size = get_config('moe.paste', 'view_initial_size')
+            size = 0
+            for index, chunk in enumerate(chunks):
+                size += len(chunk.code_raw)
+                if size > max_size:
+                    # Always send at least one chunk.
+                    chunks = chunks[:max(index, 1)]
+                    break
+
+            if len(chunks) < content.chunk_count:
+                next_block_url = url_for('paste/view-block',
+                    paste_id=paste.id, chunk=len(chunks),
+                    area_name=self.area.name)
+
+            lazy_edit = True
+        else:
+            chunks = [content]
+            # Large pastes saved before they were chunked by size.
+            lazy_edit = len(content.code_raw) > get_config('moe.paste',
+                'chunk_size')
+
+        if lazy_edit:
+            form = PasteForm(language=paste.language)
+        else:
+            form = PasteForm(code=content.code_raw, language=paste.language)
 
         context = {
-            'paste': paste,
-            'form': form,
+            'paste':          paste,
+            'chunks':         chunks,
+            'next_block_url': next_block_url,
+            'lazy_edit':      lazy_edit,
+            'form':           form,
         }
         return self.render_response('paste/view.html', **context)
 
 
+class PasteViewBlockHandler(PasteBaseHandler):
+    """Returns a chunk of a paste as JSON, for the progressive view: the
+    chunk HTML and the URL of the next chunk, if any.
+    """
+    def get(self, **kwargs):
+        paste = self.get_paste(kwargs.get('paste_id'))
+        if not paste.content.chunk_count:
+            raise NotFound()
+
+        content = paste.content
+        index = kwargs.get('chunk')
+        if index >= content.chunk_count:
+            raise NotFound()
+
+        # Chunks are highlighted with CSS classes: the style doesn't matter.
+        response = self.check_not_modified('%s|%s|%s' % (paste.id,
+            content.updated.isoformat(), index),
+            last_modified=content.updated, private=False)
+        if response is not None:
+            return response
+
+        chunk = PasteChunk.get(content.get_chunk_key(index))
+        if chunk is None:
+            raise NotFound()
+
+        next_url = None
+        if index + 1 < content.chunk_count:
+            next_url = url_for('paste/view-block', paste_id=paste.id,
+                chunk=index + 1, area_name=self.area.name)
+
+        values = {
+            'html': render_template('paste/_chunk.html', chunk=chunk),
+            'next': next_url,
+        }
+        return self.set_validators(Response(simplejson.dumps(values),
+            mimetype='application/json'))
+
 
 class PasteViewRawHandler(PasteBaseHandler):
-    """Displays a paste in raw mode, as text."""
+    """Displays a paste in raw mode, as text. A range of lines can be
+    requested with ``?lines=<first>-<last>``; only the chunks with those
+    lines are loaded. The text is sent a chunk at a time.
+    """
     def get(self, **kwargs):
-        paste_id = kwargs.pop('paste_id', None)
-        if not paste_id:
-            raise NotFound()
+        paste = self.get_paste(kwargs.pop('paste_id', None))
+
+        lines = request.args.get('lines')
+        if lines:
+            first_line, last_line = parse_line_range(lines)
+        else:
+            first_line, last_line = 1, None
+
+        response = self.check_not_modified('%s|%s|%s' % (paste.id,
+            paste.updated.isoformat(), lines), last_modified=paste.updated,
+            private=False)
+        if response is not None:
+            return response
 
-        paste = Paste.get_by_id(paste_id)
-        if not paste:
+        if not lines and not paste.content.chunk_count:
+            return self.set_validators(Response(paste.content.code_raw))
+
+        return self.set_validators(Response(paste.content.iter_lines(
+            first_line, last_line), mimetype='text/plain'))
+
+
+class PasteHighlightHandler(PasteBaseHandler):
+    """Highlights and indexes a large paste in background. Content shared
+    with a previous paste is already highlighted, and is only indexed.
+    Content stored in chunks is highlighted a few chunks per task.
+    """
+    #: Number of chunks highlighted by each task.
+    chunks_per_task = 5
+
+    def post(self, **kwargs):
+        paste = Paste.get_by_id(kwargs.get('paste_id'))
+        if paste is None or paste.is_expired or paste.content is None:
+            return ''
+
+        content = paste.content
+        if content.highlight_pending and content.is_saved():
+            if content.chunk_count:
+                index = int(self.request.form.get('chunk', 0))
+                if self.highlight_chunks(content, index):
+                    # Continue with the next chunks.
+                    from google.appengine.api.labs import taskqueue
+                    url = url_for('paste/highlight', paste_id=paste.id,
+                        area_name=self.area.name)
+                    taskqueue.add(url=url, params={
+                        'chunk': index + self.chunks_per_task})
+                    return ''
+            else:
+                content.code = self.highlight(content.code_raw,
+                    content.language) or u''
+                update_content(content.key(), code=content.code)
+
+        index_document(paste.area_key, 'paste', str(paste.id), None,
+            content.get_text())
+        return ''
+
+    def highlight_chunks(self, content, index):
+        """Highlights a batch of chunks, starting from a given index.
+
+        :return:
+            ``True`` if there are more chunks to be highlighted.
+        """
+        indexes = range(index, min(index + self.chunks_per_task,
+            content.chunk_count))
+        for chunk in db.get([content.get_chunk_key(i) for i in indexes]):
+            if chunk is not None and chunk.code is None:
+                # Lines are stored without a final newline: add it, so that
+                # a blank last line is highlighted too.
+                chunk.code = self.highlight(chunk.code_raw + u'\n',
+                    content.language, chunk.first_line) or u''
+                chunk.put()
+
+        if indexes and indexes[-1] < content.chunk_count - 1:
+            return True
+
+        content.chunks_highlighted = True
+        update_content(content.key(), chunks_highlighted=True)
+        return False
+
+    def highlight(self, code, language, first_line=1):
+        # Too large to be highlighted: it is displayed as plain text.
+        return highlight_large(code, language,
+            get_config('moe.paste', 'highlight_chunk_lines'),
+            get_config('moe.paste', 'max_highlighted_size'),
+            first_line=first_line)
+
+
+class PasteCompressionMigrationHandler(PasteBaseHandler):
+    """Compresses the code of pastes stored before it was compressed, a
+    batch per task: first shared contents, then old pastes that store their
+    own code.
+    """
+    def get(self, **kwargs):
+        return self.post(**kwargs)
+
+    def post(self, **kwargs):
+        kind = self.request.form.get('kind', 'content')
+        if kind == 'content':
+            query = PasteContent.all()
+        else:
+            query = Paste.all()
+
+        cursor, count = compress_entities(query,
+            self.request.form.get('cursor'))
+        if cursor is not None:
+            params = {'kind': kind, 'cursor': cursor}
+        elif kind == 'content':
+            # Continue with pastes.
+            params = {'kind': 'paste'}
+        else:
+            # All done.
+            return ''
+
+        # Set a task to convert the next batch.
+        from google.appengine.api.labs import taskqueue
+        url = url_for('paste/migrate-compression', area_name=self.area.name)
+        taskqueue.add(url=url, params=params)
+
+        return ''
+
+
+class PasteSweepHandler(PasteBaseHandler):
+    """Deletes expired pastes of all areas, a batch per task. Started by
+    cron.
+    """
+    def get(self, **kwargs):
+        return self.post(**kwargs)
+
+    def post(self, **kwargs):
+        cursor, count = delete_expired_pastes(self.request.form.get('cursor'))
+        if cursor is None:
+            # All done.
+            return ''
+
+        # Set a task to delete the next batch.
+        from google.appengine.api.labs import taskqueue
+        url = url_for('paste/sweep', area_name=self.area.name)
+        taskqueue.add(url=url, params={'cursor': cursor})
+
+        return ''
+
+
+class PasteStyleHandler(PasteBaseHandler):
+    """Serves the stylesheet for a style that has no precompiled file. The
+    URL includes a hash of the CSS, so it can be cached forever.
+    """
+    def get(self, **kwargs):
+        style_name = kwargs.get('style_name')
+        if not is_valid_style(style_name):
             raise NotFound()
 
-        return Response(paste.code_raw)
+        css, css_hash = get_stylesheet(style_name)
+        response = Response(css, mimetype='text/css')
+        if request.args.get('v') == css_hash:
+            response.headers['Cache-Control'] = 'public, max-age=31536000'
+            response.expires = datetime.datetime.utcnow() + \
+                datetime.timedelta(days=365)
+        else:
+            # Outdated or missing hash: don't let it stick in caches.
+            response.headers['Cache-Control'] = 'public, max-age=600'
+
+        return response
 
 
 class PasteListHandler(PasteBaseHandler):
-    """Not implemented."""
+    """Lists the latest pastes in the area, or the ones from a user."""
     def get(self, **kwargs):
+        username = kwargs.get('username')
+        if username:
+            user = User.get_by_username(username)
+            if user is None:
+                raise NotFound()
+
+            user_key = str(user.key())
+            self.add_breadcrumb('paste/list', _('Latest pastes'))
+            self.add_breadcrumb('paste/list',
+                _('Pastes by %(username)s', username=username),
+                username=username)
+        else:
+            user_key = None
+            self.add_breadcrumb('paste/list', _('Latest pastes'))
+
+        pager = paste_list_pager(self.area, user_key=user_key,
+            cursor=self.request.args.get('start'))
+
         context = {
+            'username':      username,
+            'pastes':        pager.entities,
+            'is_first_page': pager.is_first_page,
+            'next_page':     pager.next_cursor,
+            'prev_page':     pager.prev_cursor,
         }
-        return self.render_response('paste/new.html', **context)
+        return self.render_response('paste/list.html', **context)
+
+
+def parse_line_range(value):
+    """Parses a range of lines in the format ``<first>-<last>``, ``<first>-``
+    or ``<line>``. Aborts with a "400 Bad Request" if it is not valid.
+
+    :param value:
+        The range to be parsed.
+    :return:
+        A tuple ``(first_line, last_line)``. ``last_line`` is ``None`` if the
+        range goes up to the last line.
+    """
+    parts = value.split('-', 1)
+    try:
+        first_line = int(parts[0])
+        if len(parts) == 1:
+            last_line = first_line
+        elif parts[1]:
+            last_line = int(parts[1])
+        else:
+            last_line = None
+    except ValueError:
+        abort(400)
+
+    if first_line < 1 or (last_line is not None and last_line < first_line):
+        abort(400)
+
+    return first_line, last_line
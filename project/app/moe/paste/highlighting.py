@@ -9,20 +9,19 @@
     :copyright: 2007 by Armin Ronacher.
     :license: BSD
 """
-import re
-import pygments
-import csv
-from pygments.util import ClassNotFound
-from pygments.lexers import get_lexer_by_name, get_lexer_for_filename, \
-     get_lexer_for_mimetype, PhpLexer, TextLexer
-from pygments.styles import get_all_styles
-from pygments.formatters import HtmlFormatter
+import hashlib
+import os
 
-from werkzeug import escape
+from pygments.util import ClassNotFound
+from pygments.styles import get_all_styles, get_style_by_name
 
-from tipfy import local
+from tipfy import local, url_for
 from tipfy.ext.i18n import lazy_gettext as _
 
+from moe.base.highlighting import (get_formatter, highlight_chunks,
+    highlight_code)
+from moe.paste.stylesheets import STYLESHEETS, STYLESHEETS_URL
+
 #: we use a hardcoded list here because we want to keep the interface
 #: simple
 LANGUAGES = {
@@ -101,10 +100,18 @@ LANGUAGES = {
     'go':               _('Go'),
 }
 
-STYLES = dict((x, x.title()) for x in get_all_styles())
-
 DEFAULT_STYLE = 'friendly'
 
+#: Available styles, enumerated on first use by get_styles().
+_styles = None
+
+#: Cache of style names already checked by is_valid_style().
+_valid_styles = {}
+
+#: CSS and its hash for styles without a precompiled stylesheet, built once
+#: per instance by get_stylesheet().
+_stylesheets = {}
+
 
 def get_language_name(code):
     """Language name, based on the language code."""
@@ -118,6 +125,33 @@ def list_languages():
     return languages
 
 
+def get_styles():
+    """Returns a dictionary mapping all style names to titles. Enumerating
+    styles loads all Pygments style modules, so it is done only when needed.
+    """
+    global _styles
+    if _styles is None:
+        _styles = dict((x, x.title()) for x in get_all_styles())
+
+    return _styles
+
+
+def is_valid_style(style_name):
+    """Checks if a style exists, loading only that style module."""
+    valid = _valid_styles.get(style_name)
+    if valid is None:
+        try:
+            get_style_by_name(style_name)
+            valid = True
+        except ClassNotFound:
+            valid = False
+
+        if len(_valid_styles) < 100:
+            _valid_styles[style_name] = valid
+
+    return valid
+
+
 def get_style(request=None, name_only=False):
     """Style for a given request or style name."""
     if request is None:
@@ -126,14 +160,92 @@ def get_style(request=None, name_only=False):
         style_name = request
     else:
         style_name = request.cookies.get('paste.style', DEFAULT_STYLE)
-    try:
-        f = HtmlFormatter(style=style_name)
-    except ClassNotFound:
+    if not is_valid_style(style_name):
         style_name = DEFAULT_STYLE
-        f = HtmlFormatter(style=style_name)
     if name_only:
         return style_name
-    return style_name, f.get_style_defs(('#paste', '.syntax'))
+    return style_name, get_formatter(style=style_name).get_style_defs(
+        ('#paste', '.syntax'))
+
+
+def get_stylesheet(style_name):
+    """Returns the CSS for a style.
+
+    :param style_name:
+        A valid style name.
+    :return:
+        A tuple ``(css, hash)``, where ``hash`` identifies the CSS content.
+    """
+    stylesheet = _stylesheets.get(style_name)
+    if stylesheet is None:
+        css = get_formatter(style=style_name).get_style_defs(('#paste',
+            '.syntax'))
+        stylesheet = _stylesheets[style_name] = (css,
+            hashlib.md5(css.encode('utf-8')).hexdigest()[:10])
+
+    return stylesheet
+
+
+def get_stylesheet_url(style_name, area_name):
+    """Returns the URL of the stylesheet for a style. Precompiled stylesheets
+    are static files; other styles are served by ``PasteStyleHandler``. Both
+    URLs change when the CSS changes, so they can be cached forever.
+
+    :param style_name:
+        A valid style name.
+    :param area_name:
+        Name of the current area.
+    :return:
+        The stylesheet URL.
+    """
+    filename = STYLESHEETS.get(style_name)
+    if filename is not None:
+        return STYLESHEETS_URL + filename
+
+    return url_for('paste/style', style_name=style_name, area_name=area_name,
+        v=get_stylesheet(style_name)[1])
+
+
+def build_stylesheets(directory):
+    """Writes a stylesheet for each available style, named after the style
+    and a hash of its content, and the ``moe.paste.stylesheets`` module that
+    maps styles to file names. Run it after upgrading Pygments.
+
+    :param directory:
+        Directory where stylesheets are written. It must be served from
+        ``STYLESHEETS_URL``.
+    :return:
+        A dictionary mapping style names to file names.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    stylesheets = {}
+    for style_name in sorted(get_styles()):
+        css, css_hash = get_stylesheet(style_name)
+        filename = '%s.%s.css' % (style_name, css_hash)
+        f = open(os.path.join(directory, filename), 'w')
+        try:
+            f.write(css)
+        finally:
+            f.close()
+
+        stylesheets[style_name] = filename
+
+    lines = ['# -*- coding: utf-8 -*-',
+        '# Generated by moe.paste.highlighting.build_stylesheets().',
+        'STYLESHEETS_URL = %r' % STYLESHEETS_URL,
+        'STYLESHEETS = {']
+    lines.extend('    %r: %r,' % item for item in sorted(stylesheets.items()))
+    lines.append('}')
+
+    f = open(os.path.join(os.path.dirname(__file__), 'stylesheets.py'), 'w')
+    try:
+        f.write('\n'.join(lines) + '\n')
+    finally:
+        f.close()
+
+    return stylesheets
 
 
 def highlight(code, language, _preview=False):
@@ -158,11 +270,40 @@ def highlight(code, language, _preview=False):
         lexer = PhpLexer(startinline=True)
     else:
     """
-    try:
-        lexer = get_lexer_by_name(language)
-    except ClassNotFound:
-        lexer = TextLexer()
-    style = get_style(name_only=True)
-    formatter = HtmlFormatter(linenos=True, cssclass='syntax', style=style)
-    return u'<div class="highlight">%s</div>' % \
-           pygments.highlight(code, lexer, formatter)
+    # Highlighted with CSS classes: the style is only used to select the
+    # stylesheet, so it is not part of the options nor of the cache key.
+    return u'<div class="highlight">%s</div>' % highlight_code(code,
+        language, linenos=True, cssclass='syntax')
+
+
+def highlight_large(code, language, chunk_lines, max_size, first_line=1):
+    """Highlight a large code to HTML, a chunk of lines at a time.
+
+    :param code:
+        The code to be highlighted.
+    :param language:
+        Language code.
+    :param chunk_lines:
+        Number of lines highlighted at a time.
+    :param max_size:
+        Maximum size of the resulting HTML.
+    :param first_line:
+        Line number of the first line of code.
+    :return:
+        The highlighted code, or ``None`` if it would exceed ``max_size``.
+    """
+    # End every line with a newline, so that blank lines at the end of the
+    # code or of a chunk are kept.
+    code = u''.join(line + u'\n' for line in code.splitlines())
+    parts = [u'<div class="highlight">']
+    size = 0
+    for html in highlight_chunks(code, language, chunk_lines=chunk_lines,
+        first_line=first_line, linenos=True, cssclass='syntax'):
+        size += len(html)
+        if size > max_size:
+            return None
+
+        parts.append(html)
+
+    parts.append(u'</div>')
+    return u''.join(parts)
@@ -8,14 +8,171 @@
     :copyright: 2010 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
+import datetime
+import hashlib
+
 from google.appengine.ext import db
 
 from tipfy.ext.wtforms import Form, fields, validators
 
-from tipfy import cached_property
+from tipfy import cached_property, get_config
 from tipfy.ext.i18n import lazy_gettext, _
 
+from moe.base.pager import Pager
+from moe.base.properties import CompressedTextProperty
 from moe.paste.highlighting import list_languages, get_language_name
+from moe.search.models import unindex_document
+
+#: Expiry options for new pastes: name, label and lifetime.
+EXPIRY_OPTIONS = [
+    ('never', lazy_gettext('Never'),   None),
+    ('day',   lazy_gettext('1 day'),   datetime.timedelta(days=1)),
+    ('month', lazy_gettext('1 month'), datetime.timedelta(days=30)),
+]
+
+
+class PasteContent(db.Model):
+    """The code of a paste, shared by all pastes with the same code and
+    language. Key name is ``<language>:<hash of the code>``.
+
+    Code with more lines than the ``chunk_lines`` config is stored in
+    :class:`PasteChunk` entities, so that line ranges can be loaded without
+    loading the whole code.
+    """
+    # Creation date.
+    created = db.DateTimeProperty(auto_now_add=True)
+    # Modification date.
+    updated = db.DateTimeProperty(auto_now=True)
+    # Original code, if it is not stored in chunks.
+    code_raw = CompressedTextProperty()
+    # Highlighted code, if it is not stored in chunks. ``None`` while a
+    # background task highlights it, or empty if it is too large to be
+    # highlighted.
+    code = CompressedTextProperty()
+    # Language code.
+    language = db.StringProperty()
+    # Number of chunks, or ``None`` if the code is not stored in chunks.
+    chunk_count = db.IntegerProperty()
+    # Number of lines in each chunk.
+    chunk_lines = db.IntegerProperty()
+    # Number of lines, if the code is stored in chunks.
+    line_count = db.IntegerProperty()
+    # True when all chunks are highlighted.
+    chunks_highlighted = db.BooleanProperty(default=False)
+    # Number of pastes using this content, changed in transactions when
+    # pastes are saved or deleted. ``None`` for contents saved before it was
+    # counted: they are never deleted.
+    paste_count = db.IntegerProperty()
+
+    @cached_property
+    def lines(self):
+        """Number of lines."""
+        if self.chunk_count:
+            return self.line_count
+
+        return len(self.code_raw.splitlines())
+
+    @property
+    def highlight_pending(self):
+        """``True`` while the code is being highlighted in background."""
+        if self.chunk_count:
+            return not self.chunks_highlighted
+
+        return self.code is None
+
+    def get_chunks(self, first_line=1, last_line=None):
+        """Returns the chunks that contain a range of lines. Code that is not
+        stored in chunks is returned as a single chunk.
+
+        :param first_line:
+            First line of the range, starting from 1.
+        :param last_line:
+            Last line of the range, or ``None`` to get up to the last one.
+        :return:
+            A list of :class:`PasteChunk` entities, or a list with this
+            entity if the code is not stored in chunks.
+        """
+        if not self.chunk_count:
+            return [self]
+
+        keys = [self.get_chunk_key(index) for index in
+            self.get_chunk_range(first_line, last_line)]
+        return [chunk for chunk in db.get(keys) if chunk is not None]
+
+    def iter_lines(self, first_line=1, last_line=None):
+        """Returns the raw code of a range of lines, loading one chunk at a
+        time.
+
+        :param first_line:
+            First line of the range, starting from 1.
+        :param last_line:
+            Last line of the range, or ``None`` to get up to the last one.
+        :return:
+            A generator with the text of the range, a chunk at a time. Line
+            breaks are normalized to ``\\n``.
+        """
+        if not self.chunk_count:
+            lines = self.code_raw.splitlines()[first_line - 1:last_line]
+            if lines:
+                yield u'\n'.join(lines) + u'\n'
+
+            return
+
+        for index in self.get_chunk_range(first_line, last_line):
+            chunk = PasteChunk.get(self.get_chunk_key(index))
+            if chunk is None:
+                continue
+
+            lines = chunk.code_raw.splitlines()
+            start = max(first_line - chunk.first_line, 0)
+            if last_line is None:
+                end = len(lines)
+            else:
+                end = last_line - chunk.first_line + 1
+
+            if lines[start:end]:
+                yield u'\n'.join(lines[start:end]) + u'\n'
+
+    def get_text(self):
+        """Returns the whole raw code."""
+        if not self.chunk_count:
+            return self.code_raw
+
+        return u''.join(self.iter_lines())
+
+    def get_chunk_range(self, first_line=1, last_line=None):
+        """Returns the indexes of the chunks with a range of lines."""
+        first = max(first_line - 1, 0) // self.chunk_lines
+        if last_line is None:
+            last = self.chunk_count - 1
+        else:
+            last = min((last_line - 1) // self.chunk_lines,
+                self.chunk_count - 1)
+
+        return range(first, last + 1)
+
+    def get_chunk_key(self, index):
+        return db.Key.from_path(PasteChunk.kind(), 'c%d' % index,
+            parent=self.key())
+
+    @classmethod
+    def get_key_name(cls, code_raw, language):
+        """Returns the key name for a code and language."""
+        return '%s:%s' % (language, hashlib.sha1(
+            code_raw.encode('utf-8')).hexdigest())
+
+
+class PasteChunk(db.Model):
+    """A range of lines of a :class:`PasteContent`, which is its parent. Key
+    name is ``c<index>``, starting from 0.
+    """
+    # Number of the first line in this chunk, starting from 1.
+    first_line = db.IntegerProperty()
+    # Original code.
+    code_raw = CompressedTextProperty()
+    # Highlighted code. ``None`` until it is highlighted, or empty if it is
+    # too large to be highlighted.
+    code = CompressedTextProperty()
 
 
 class Paste(db.Model):
@@ -27,12 +184,19 @@ class Paste(db.Model):
     area_key = db.StringProperty()
     # Reference identifier to an authenticated user.
     user_key = db.StringProperty()
-    # Original code.
-    code_raw = db.TextProperty()
-    # Highlighted code.
-    code = db.TextProperty()
+    # Key to the PasteContent with the code.
+    content_key = db.StringProperty()
+    # Original code, for pastes saved before PasteContent was used.
+    code_raw = CompressedTextProperty()
+    # Highlighted code, for pastes saved before PasteContent was used.
+    code = CompressedTextProperty()
     # Language code.
     language = db.StringProperty()
+    # Expiration date, or ``None`` if the paste doesn't expire.
+    expires = db.DateTimeProperty()
+
+    #: The PasteContent, set by the content property or prefetch_contents().
+    _content = None
 
     @cached_property
     def id(self):
@@ -41,12 +205,95 @@ class Paste(db.Model):
     @cached_property
     def lines(self):
         """Number of lines."""
-        return len(self.code_raw.splitlines())
+        return self.content.lines
 
     @cached_property
     def language_name(self):
         return get_language_name(self.language)
 
+    @property
+    def is_expired(self):
+        """``True`` if the paste expired, even if it was not deleted yet."""
+        return self.expires is not None and \
+            self.expires <= datetime.datetime.now()
+
+    @property
+    def content(self):
+        """The :class:`PasteContent` for this paste. Old pastes store their
+        code themselves: they get an unsaved content with their code.
+        """
+        if self._content is None:
+            if self.content_key is None:
+                self._content = PasteContent(code_raw=self.code_raw,
+                    code=self.code, language=self.language,
+                    created=self.created, updated=self.updated)
+            else:
+                self._content = PasteContent.get(self.content_key)
+
+        return self._content
+
+
+class PasteSummary(db.Model):
+    """Data displayed in paste listings, so that listings don't load the
+    code. Key id is the id of the paste.
+    """
+    # Creation date of the paste.
+    created = db.DateTimeProperty(indexed=False)
+    # Reference identifier to the author.
+    user_key = db.StringProperty(indexed=False)
+    # Name of the author.
+    username = db.StringProperty(indexed=False)
+    # Language code.
+    language = db.StringProperty(indexed=False)
+    # Number of lines.
+    lines = db.IntegerProperty(indexed=False)
+    # Beginning of the first line that is not blank.
+    first_line = db.StringProperty(indexed=False)
+    # Expiration date of the paste, or ``None`` if it doesn't expire.
+    expires = db.DateTimeProperty(indexed=False)
+
+    @property
+    def is_expired(self):
+        return self.expires is not None and \
+            self.expires <= datetime.datetime.now()
+
+    @cached_property
+    def id(self):
+        return self.key().id()
+
+    @cached_property
+    def language_name(self):
+        return get_language_name(self.language)
+
+    @classmethod
+    def from_paste(cls, paste, username=None):
+        """Returns a new summary for a paste.
+
+        :param paste:
+            A :class:`Paste` entity.
+        :param username:
+            Name of the author, if any.
+        :return:
+            A :class:`PasteSummary` entity, not saved.
+        """
+        first_line = u''
+        for text in paste.content.iter_lines(1, 20):
+            for line in text.splitlines():
+                if line.strip():
+                    first_line = line.strip()[:100]
+                    break
+
+            break
+
+        return cls(key=cls.get_key(paste.id), created=paste.created,
+            user_key=paste.user_key, username=username,
+            language=paste.language, lines=paste.content.lines,
+            first_line=first_line, expires=paste.expires)
+
+    @classmethod
+    def get_key(cls, paste_id):
+        return db.Key.from_path(cls.kind(), paste_id)
+
 
 class PasteForm(Form):
     code = fields.TextAreaField(lazy_gettext('Code'), validators=[
@@ -54,3 +301,384 @@ class PasteForm(Form):
     language = fields.SelectField(lazy_gettext('Language'),
         choices=list_languages())
     insert_tab = fields.BooleanField(lazy_gettext('Activate tab key'))
+    expiry = fields.SelectField(lazy_gettext('Delete after'),
+        choices=[(name, label) for name, label, lifetime in EXPIRY_OPTIONS],
+        default='never')
+
+
+def save_paste(area_key, user_key, code_raw, language, highlight_func=None,
+    username=None, expiry=None):
+    """Saves a new paste. The code is stored only once for all pastes with
+    the same code and language. Code with more lines than the
+    ``chunk_lines`` config or more characters than the ``chunk_size``
+    config is stored in chunks, and is always highlighted in background.
+
+    :param area_key:
+        Key of the area where the paste is published, as a string.
+    :param user_key:
+        Key of the author, as a string, or ``None``.
+    :param code_raw:
+        The code.
+    :param language:
+        Language code.
+    :param highlight_func:
+        A function called with the code and language to highlight new code,
+        or ``None`` to leave it to be highlighted in background.
+    :param username:
+        Name of the author, displayed in listings.
+    :param expiry:
+        Name of one of the :data:`EXPIRY_OPTIONS`, or ``None`` for a paste
+        that doesn't expire.
+    :return:
+        The new :class:`Paste`.
+    """
+    key_name = PasteContent.get_key_name(code_raw, language)
+    content = count_content_paste(key_name)
+    if content is None:
+        # New code, or the content was deleted meanwhile. Both functions
+        # count the paste in an existing content if it was saved meanwhile.
+        lines = code_raw.splitlines()
+        chunk_lines = get_chunk_lines(len(lines), len(code_raw))
+        if chunk_lines:
+            content = save_chunked_content(key_name, lines, language,
+                chunk_lines)
+        else:
+            values = {'code_raw': code_raw, 'language': language}
+            if highlight_func is not None:
+                values['code'] = highlight_func(code_raw, language)
+
+            content = add_content_paste(key_name, **values)
+
+    paste = Paste(area_key=area_key, user_key=user_key,
+        content_key=str(content.key()), language=language,
+        expires=get_expiry_date(expiry))
+    paste._content = content
+    paste.put()
+    PasteSummary.from_paste(paste, username=username).put()
+    return paste
+
+
+def get_chunk_lines(line_count, size):
+    """Returns the number of lines per chunk to store code in chunks. Code
+    larger than the ``chunk_size`` config gets fewer lines per chunk, so
+    that chunks have about that size.
+
+    :param line_count:
+        Number of lines of the code.
+    :param size:
+        Number of characters of the code.
+    :return:
+        The number of lines per chunk, or ``None`` if the code is stored in
+        a single entity.
+    """
+    chunk_lines = get_config('moe.paste', 'chunk_lines')
+    chunk_size = get_config('moe.paste', 'chunk_size')
+    if size > chunk_size:
+        chunk_lines = min(chunk_lines, max(line_count * chunk_size // size,
+            1))
+
+    if line_count > chunk_lines:
+        return chunk_lines
+
+
+def get_expiry_date(expiry):
+    """Returns the expiration date for a new paste.
+
+    :param expiry:
+        Name of one of the :data:`EXPIRY_OPTIONS`.
+    :return:
+        A ``datetime``, or ``None`` if the paste doesn't expire.
+    """
+    for name, label, lifetime in EXPIRY_OPTIONS:
+        if name == expiry and lifetime is not None:
+            return datetime.datetime.now() + lifetime
+
+
+def count_content_paste(key_name):
+    """Counts a new paste using an existing :class:`PasteContent`, in the
+    same transaction that loads it.
+
+    :param key_name:
+        Key name of the :class:`PasteContent`.
+    :return:
+        The :class:`PasteContent` entity, or ``None`` if it doesn't exist.
+    """
+    def txn():
+        content = PasteContent.get_by_key_name(key_name)
+        if content is not None and content.paste_count is not None:
+            content.paste_count += 1
+            content.put()
+
+        return content
+
+    return db.run_in_transaction(txn)
+
+
+def add_content_paste(key_name, **values):
+    """Counts a new paste using a :class:`PasteContent`, creating the
+    content if it doesn't exist, in a transaction.
+
+    :param key_name:
+        Key name for the :class:`PasteContent`.
+    :param values:
+        Property values for a new content.
+    :return:
+        The :class:`PasteContent` entity.
+    """
+    def txn():
+        content = PasteContent.get_by_key_name(key_name)
+        if content is None:
+            content = PasteContent(key_name=key_name, paste_count=1,
+                **values)
+        elif content.paste_count is not None:
+            content.paste_count += 1
+        else:
+            return content
+
+        content.put()
+        return content
+
+    return db.run_in_transaction(txn)
+
+
+def remove_content_paste(key):
+    """Discounts a deleted paste from a :class:`PasteContent`, in a
+    transaction. The content is deleted when no paste uses it anymore.
+
+    :param key:
+        Key of the :class:`PasteContent`.
+    :return:
+        ``True`` if the content was deleted.
+    """
+    def txn():
+        content = PasteContent.get(key)
+        if content is None or content.paste_count is None:
+            return False
+
+        content.paste_count -= 1
+        if content.paste_count > 0:
+            content.put()
+            return False
+
+        content.delete()
+        return True
+
+    if not db.run_in_transaction(txn):
+        return False
+
+    delete_orphan_chunks(key)
+    return True
+
+
+def update_content(key, **values):
+    """Updates properties of a :class:`PasteContent` in a transaction, so
+    that the paste count is not overwritten.
+
+    :param key:
+        Key of the :class:`PasteContent`.
+    :param values:
+        Property values to be set.
+    :return:
+        The :class:`PasteContent` entity, or ``None`` if it doesn't exist.
+    """
+    def txn():
+        content = PasteContent.get(key)
+        if content is not None:
+            for name, value in values.iteritems():
+                setattr(content, name, value)
+
+            content.put()
+
+        return content
+
+    return db.run_in_transaction(txn)
+
+
+def save_chunked_content(key_name, lines, language, chunk_lines):
+    """Saves code in chunks of lines, if it is not saved yet, and counts a
+    new paste using it.
+
+    :param key_name:
+        Key name for the :class:`PasteContent`.
+    :param lines:
+        The lines of code.
+    :param language:
+        Language code.
+    :param chunk_lines:
+        Number of lines in each chunk.
+    :return:
+        The :class:`PasteContent` entity.
+    """
+    content = PasteContent(key_name=key_name, language=language,
+        chunk_count=(len(lines) + chunk_lines - 1) // chunk_lines,
+        chunk_lines=chunk_lines, line_count=len(lines), paste_count=1)
+
+    chunks = []
+    for index in range(content.chunk_count):
+        start = index * chunk_lines
+        chunks.append(PasteChunk(key=content.get_chunk_key(index),
+            first_line=start + 1,
+            code_raw=u'\n'.join(lines[start:start + chunk_lines])))
+
+    def txn():
+        existing = PasteContent.get_by_key_name(key_name)
+        if existing is not None:
+            if existing.paste_count is not None:
+                existing.paste_count += 1
+                existing.put()
+
+            return existing
+
+        db.put([content] + chunks)
+        return content
+
+    return db.run_in_transaction(txn)
+
+
+def prefetch_contents(pastes):
+    """Loads the :class:`PasteContent` of a list of pastes in a batch.
+
+    :param pastes:
+        A list of :class:`Paste` entities.
+    :return:
+        The same list.
+    """
+    pending = [paste for paste in pastes if paste._content is None and
+        paste.content_key is not None]
+    if pending:
+        contents = db.get([paste.content_key for paste in pending])
+        for paste, content in zip(pending, contents):
+            paste._content = content
+
+    return pastes
+
+
+def get_paste_summaries(keys):
+    """Loads the :class:`PasteSummary` for a list of paste keys in a batch.
+    Summaries missing for pastes saved before summaries were used are built
+    and saved.
+
+    :param keys:
+        A list of :class:`Paste` keys.
+    :return:
+        A list of :class:`PasteSummary` entities, in the same order.
+    """
+    summaries = db.get([PasteSummary.get_key(key.id()) for key in keys])
+    missing = [i for i, summary in enumerate(summaries) if summary is None]
+    if missing:
+        pastes = prefetch_contents([paste for paste in db.get([keys[i] for
+            i in missing]) if paste is not None])
+        user_keys = list(set(paste.user_key for paste in pastes
+            if paste.user_key))
+        usernames = dict((str(user.key()), user.username) for user in
+            db.get([db.Key(key) for key in user_keys]) if user is not None)
+        new_summaries = dict((paste.id, PasteSummary.from_paste(paste,
+            usernames.get(paste.user_key))) for paste in pastes
+            if paste.content is not None)
+        db.put(new_summaries.values())
+        for i in missing:
+            summaries[i] = new_summaries.get(keys[i].id())
+
+    # Expired pastes are hidden until they are deleted.
+    return [summary for summary in summaries if summary is not None and
+        not summary.is_expired]
+
+
+def paste_list_pager(area, user_key=None, cursor=None, limit=20):
+    """Returns a :class:`moe.base.pager.Pager` with summaries of the latest
+    pastes in an area, optionally only the ones from a given user. Pastes
+    are queried by key only, and the summaries are loaded with a batch get.
+    """
+    area_key = str(area.key())
+    query = Paste.all(keys_only=True).filter('area_key', area_key)
+    if user_key is not None:
+        query.filter('user_key', user_key)
+
+    def match(paste):
+        return paste.area_key == area_key and (user_key is None or
+            paste.user_key == user_key)
+
+    pager = Pager(query.order('-created'), limit=limit,
+        prefetch=get_paste_summaries, match=match)
+    pager.fetch(cursor)
+    return pager
+
+
+def delete_expired_pastes(cursor=None, limit=100):
+    """Deletes a batch of expired pastes of all areas, with their summaries
+    and search documents. Contents are deleted when no other paste uses
+    them.
+
+    :param cursor:
+        A cursor returned by the previous batch, or ``None`` to start.
+    :param limit:
+        Maximum number of pastes deleted by this batch.
+    :return:
+        A tuple ``(cursor, count)`` with the cursor for the next batch, or
+        ``None`` if there are no more expired pastes, and the number of
+        deleted pastes.
+    """
+    # Pastes that don't expire have no date, and are excluded by the lower
+    # bound. The query is not filtered by area, so a sweep started from any
+    # area deletes the expired pastes of all of them.
+    query = Paste.all(keys_only=True) \
+                 .filter('expires >', datetime.datetime(1970, 1, 1)) \
+                 .filter('expires <=', datetime.datetime.now()) \
+                 .order('expires')
+    if cursor is not None:
+        query.with_cursor(cursor)
+
+    keys = query.fetch(limit)
+    if not keys:
+        return None, 0
+
+    def txn(key):
+        # Only the sweep that deletes the paste discounts it from its
+        # content, even if another one got it from the query.
+        paste = Paste.get(key)
+        if paste is not None:
+            paste.delete()
+
+        return paste
+
+    for key, paste in zip(keys, db.get(keys)):
+        if paste is None:
+            continue
+
+        # Removed from the index first: if this fails, the paste is still
+        # found by the next sweep and removed again.
+        unindex_document(paste.area_key, 'paste', str(paste.id))
+        paste = db.run_in_transaction(txn, key)
+        if paste is None:
+            continue
+
+        db.delete(PasteSummary.get_key(key.id()))
+        if paste.content_key:
+            remove_content_paste(db.Key(paste.content_key))
+
+    if len(keys) == limit:
+        return query.cursor(), len(keys)
+
+    return None, len(keys)
+
+
+def delete_orphan_chunks(key):
+    """Deletes the :class:`PasteChunk` entities of a deleted
+    :class:`PasteContent`, a batch per transaction. It stops if the content
+    is saved again meanwhile, as its chunks are then saved again too.
+
+    :param key:
+        Key of the deleted :class:`PasteContent`.
+    :return:
+        ``None``.
+    """
+    def txn():
+        if PasteContent.get(key) is not None:
+            return False
+
+        keys = PasteChunk.all(keys_only=True).ancestor(key).fetch(200)
+        db.delete(keys)
+        return len(keys) == 200
+
+    while db.run_in_transaction(txn):
+        pass
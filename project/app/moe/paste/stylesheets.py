@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by moe.paste.highlighting.build_stylesheets().
+STYLESHEETS_URL = '/static/default/styles/pygments/'
+STYLESHEETS = {
+    'autumn': 'autumn.05777ff978.css',
+    'borland': 'borland.1d20ac4fcd.css',
+    'bw': 'bw.01762dac5c.css',
+    'colorful': 'colorful.41961244c8.css',
+    'default': 'default.b47fa6766d.css',
+    'emacs': 'emacs.70bd9af274.css',
+    'friendly': 'friendly.7cae069428.css',
+    'fruity': 'fruity.5698db834c.css',
+    'manni': 'manni.26695aab4e.css',
+    'monokai': 'monokai.442a7bf289.css',
+    'murphy': 'murphy.ba719cae70.css',
+    'native': 'native.2ffa446c0e.css',
+    'pastie': 'pastie.3e7fa8da6a.css',
+    'perldoc': 'perldoc.e591ebb7fa.css',
+    'tango': 'tango.0f3f1786e2.css',
+    'trac': 'trac.82ca37d2bf.css',
+    'vs': 'vs.b32d465357.css',
+}
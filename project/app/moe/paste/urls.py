@@ -22,8 +22,18 @@ def get_rules():
     rules = [
         Rule('/', endpoint='paste/index', handler='moe.paste.handlers.PasteNewHandler', **kwargs),
         Rule('/+<language>', endpoint='paste/index', handler='moe.paste.handlers.PasteNewHandler', **kwargs),
+        Rule('/list', endpoint='paste/list', handler='moe.paste.handlers.PasteListHandler', **kwargs),
+        Rule('/list/<username>', endpoint='paste/list', handler='moe.paste.handlers.PasteListHandler', **kwargs),
         Rule('/view/<int:paste_id>', endpoint='paste/view', handler='moe.paste.handlers.PasteViewHandler', **kwargs),
+        Rule('/view-block/<int:paste_id>/<int:chunk>', endpoint='paste/view-block', handler='moe.paste.handlers.PasteViewBlockHandler', **kwargs),
         Rule('/view-raw/<int:paste_id>', endpoint='paste/view-raw', handler='moe.paste.handlers.PasteViewRawHandler', **kwargs),
+        # Task to highlight large pastes. Protected by app.yaml.
+        Rule('/tasks/highlight/<int:paste_id>', endpoint='paste/highlight', handler='moe.paste.handlers.PasteHighlightHandler', **kwargs),
+        # Task to compress the code of pastes saved uncompressed.
+        Rule('/tasks/migrate-compression', endpoint='paste/migrate-compression', handler='moe.paste.handlers.PasteCompressionMigrationHandler', **kwargs),
+        # Task to delete expired pastes. Started by cron.yaml.
+        Rule('/tasks/sweep', endpoint='paste/sweep', handler='moe.paste.handlers.PasteSweepHandler', **kwargs),
+        Rule('/style/<style_name>.css', endpoint='paste/style', handler='moe.paste.handlers.PasteStyleHandler', **kwargs),
     ]
 
     return rules
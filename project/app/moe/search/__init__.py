@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+#: Default configuration values for this module. Keys are:
+#: - ``posting_shards``: Number of shards for the posting list of each term.
+#:   Each document is stored in the same shard for all its terms, so saving
+#:   a document updates one entity per term, and a query loads all shards of
+#:   its terms with a single get. Changing it requires rebuilding the index.
+#:   Default is 16.
+#: - ``max_document_terms``: Maximum number of distinct terms indexed for a
+#:   document; the most frequent ones are kept. Default is 1000.
+#: - ``max_query_terms``: Maximum number of terms used from a query. Default
+#:   is 5.
+#: - ``result_cache_time``: Time in seconds to keep ranked results of a query
+#:   in memcache, to page through them. Default is 300.
+default_config = {
+    'posting_shards':     16,
+    'max_document_terms': 1000,
+    'max_query_terms':    5,
+    'result_cache_time':  300,
+}
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    moe.search.handlers
+    ~~~~~~~~~~~~~~~~~~~
+
+    Search handlers.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+from tipfy import url_for
+from tipfy.ext.i18n import _
+
+from moe.base.handlers import AreaRequestHandler
+from moe.search.models import KIND_PREFIXES, index_document, search
+
+
+class SearchHandler(AreaRequestHandler):
+    """Searches wiki pages and pastes."""
+    def get(self, **kwargs):
+        self.request.context['current_app'] = 'search'
+        self.request.context['breadcrumbs'] = [
+            (url_for('home/index', area_name=self.area.name), _('Home')),
+            (url_for('search/index', area_name=self.area.name), _('Search')),
+        ]
+
+        query = self.request.args.get('q', u'').strip()
+        kind = self.request.args.get('kind')
+        if kind not in KIND_PREFIXES:
+            kind = None
+
+        cursor = self.request.args.get('start')
+        if query:
+            documents, next_cursor, count = search(str(self.area.key()),
+                query, kind=kind, cursor=cursor)
+        else:
+            documents, next_cursor, count = [], None, 0
+
+        context = {
+            'query':         query,
+            'kind':          kind,
+            'documents':     documents,
+            'count':         count,
+            'is_first_page': not cursor,
+            'next_page':     next_cursor,
+        }
+        return self.render_response('search/results.html', **context)
+
+
+class SearchIndexTaskHandler(AreaRequestHandler):
+    """Indexes a wiki page or a paste after it is saved."""
+    def get(self, **kwargs):
+        return self.post(**kwargs)
+
+    def post(self, **kwargs):
+        kind = self.request.form.get('kind')
+        ref = self.request.form.get('ref')
+
+        if kind == 'wiki' and ref:
+            from moe.wiki.models import WikiRevision
+            revision = WikiRevision.get_revision(self.area, ref)
+            if revision is not None:
+                index_document(str(self.area.key()), 'wiki', ref,
+                    revision.title, revision.body_raw)
+        elif kind == 'paste' and ref and ref.isdigit():
+            from moe.paste.models import Paste
+            paste = Paste.get_by_id(int(ref))
+            if paste is not None and paste.content is not None:
+                index_document(paste.area_key, 'paste', ref, None,
+                    paste.content.get_text())
+
+        return ''
+
+
+class SearchIndexBuildHandler(AreaRequestHandler):
+    """Builds the search index for existing wiki pages and pastes, a batch
+    per task.
+    """
+    def get(self, **kwargs):
+        return self.post(**kwargs)
+
+    def post(self, **kwargs):
+        from moe.paste.models import Paste
+        from moe.wiki.models import WikiPage, WikiRevision
+
+        kind = self.request.form.get('kind', 'wiki')
+        cursor = self.request.form.get('cursor')
+
+        if kind == 'wiki':
+            query = WikiPage.all()
+        else:
+            query = Paste.all()
+
+        if cursor is not None:
+            query.with_cursor(cursor)
+
+        entities = query.fetch(20)
+        if kind == 'wiki':
+            revisions = WikiRevision.get_by_key_name([page.key().name() for
+                page in entities])
+            for page, revision in zip(entities, revisions):
+                if revision is not None:
+                    index_document(page.area_key, 'wiki', page.path,
+                        revision.title, revision.body_raw)
+        else:
+            from moe.paste.models import prefetch_contents
+            for paste in prefetch_contents(entities):
+                if paste.content is not None:
+                    index_document(paste.area_key, 'paste', str(paste.id),
+                        None, paste.content.get_text())
+
+        if len(entities) == 20:
+            params = {'kind': kind, 'cursor': query.cursor()}
+        elif kind == 'wiki':
+            # Continue with pastes.
+            params = {'kind': 'paste'}
+        else:
+            # All done.
+            return ''
+
+        # Set a task to index the next batch.
+        from google.appengine.api.labs import taskqueue
+        url = url_for('search/build-index', area_name=self.area.name)
+        taskqueue.add(url=url, params=params)
+
+        return ''
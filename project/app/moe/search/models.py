@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+"""
+    moe.search.models
+    ~~~~~~~~~~~~~~~~~
+
+    Inverted index for full text search.
+
+    Each indexed document has a :class:`SearchDocument` with the count of
+    its terms. Documents are split by id in :class:`SearchShard` entity
+    groups: the shard stores the lengths of its documents, and its children
+    are :class:`SearchPostings` entities with the counts of the documents
+    using a term. A document is always stored in the same shard, so saving it
+    only updates the postings of the terms whose count changed, with batch
+    gets and puts in a few transactions.
+
+    Documents are indexed by tasks, so that saving a page or a paste doesn't
+    wait for the index to be updated. Queries load all shards of their terms
+    and the document lengths in a single batch get, and rank the documents
+    that have all terms by tf-idf, normalizing term counts by the document
+    lengths. Ranked results are cached for a while to page through them.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import bisect
+import hashlib
+import math
+import re
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from tipfy import get_config, url_for
+from tipfy.ext.db import PickleProperty
+
+#: Prefixes used in document ids for each kind of document.
+KIND_PREFIXES = {
+    'wiki':  'w',
+    'paste': 'p',
+}
+
+#: Maximum number of ranked results kept for a query.
+MAX_RESULTS = 1000
+
+#: Maximum number of postings updated in a transaction.
+POSTINGS_BATCH_SIZE = 400
+
+#: Weight of terms found in document titles, relative to the body.
+TITLE_WEIGHT = 3
+
+#: Words that are too common to be indexed.
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if',
+    'in', 'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that',
+    'the', 'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was',
+    'will', 'with',
+])
+
+_word_re = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+class SearchDocument(db.Model):
+    """An indexed document. Key name is ``<area key>:<document id>``."""
+    # Modification date.
+    updated = db.DateTimeProperty(auto_now=True)
+    # Key to the area where this document is published.
+    area_key = db.StringProperty()
+    # Document kind: 'wiki' or 'paste'.
+    doc_kind = db.StringProperty()
+    # Reference to the document: page path or paste id.
+    ref = db.StringProperty()
+    # Document title.
+    title = db.StringProperty()
+    # Beginning of the document text.
+    summary = db.TextProperty()
+    # A dictionary mapping indexed terms to their counts.
+    counts = PickleProperty()
+    # Total count of indexed terms, used to normalize term frequencies.
+    length = db.IntegerProperty(default=0)
+
+    @property
+    def doc_id(self):
+        return self.key().name().split(':', 1)[1]
+
+
+class SearchShard(db.Model):
+    """A shard of the index of an area. Key name is ``<area key>:<shard>``.
+    It is the parent of the posting lists of its documents.
+    """
+    # A dictionary mapping document ids to their total count of terms.
+    lengths = PickleProperty()
+
+
+class SearchPostings(db.Model):
+    """A shard of the posting list for a term. Parent is a
+    :class:`SearchShard`, and key name is ``t:<term>``.
+    """
+    # A dictionary mapping document ids to term counts.
+    postings = PickleProperty()
+
+
+class SearchStats(db.Model):
+    """Index statistics for an area. Key name is the area key."""
+    # Number of indexed documents.
+    doc_count = db.IntegerProperty(default=0)
+
+
+def tokenize(text):
+    """Splits a text into normalized terms.
+
+    :param text:
+        A text to be tokenized.
+    :return:
+        A list of terms, in the order they appear in the text.
+    """
+    if not text:
+        return []
+
+    return [word for word in _word_re.findall(text.lower())
+        if 1 < len(word) <= 30 and word not in STOP_WORDS]
+
+
+def get_term_counts(title, text):
+    """Returns the counts of the terms of a document. Terms in the title
+    count :data:`TITLE_WEIGHT` times.
+
+    :param title:
+        Document title.
+    :param text:
+        Document text.
+    :return:
+        A dictionary mapping terms to counts.
+    """
+    counts = {}
+    for term in tokenize(text):
+        counts[term] = counts.get(term, 0) + 1
+
+    for term in tokenize(title):
+        counts[term] = counts.get(term, 0) + TITLE_WEIGHT
+
+    max_terms = get_config('moe.search', 'max_document_terms')
+    if len(counts) > max_terms:
+        terms = sorted(counts, key=counts.get, reverse=True)[:max_terms]
+        counts = dict((term, counts[term]) for term in terms)
+
+    return counts
+
+
+def index_document(area_key, kind, ref, title, text):
+    """Adds a document to the index, or updates it. Only the postings of the
+    terms that changed are updated.
+
+    :param area_key:
+        Key of the area where the document is published, as a string.
+    :param kind:
+        Document kind: 'wiki' or 'paste'.
+    :param ref:
+        Reference to the document: page path or paste id.
+    :param title:
+        Document title, or ``None``.
+    :param text:
+        Document text.
+    :return:
+        The :class:`SearchDocument` entity.
+    """
+    doc_id = get_doc_id(kind, ref)
+    key_name = '%s:%s' % (area_key, doc_id)
+    counts = get_term_counts(title, text)
+
+    doc = SearchDocument.get_by_key_name(key_name)
+    if doc is not None:
+        old_counts = doc.counts or {}
+    else:
+        old_counts = {}
+
+    changed = dict((term, count) for term, count in counts.iteritems()
+        if old_counts.get(term) != count)
+    removed = [term for term in old_counts if term not in counts]
+    length = sum(counts.itervalues())
+    update_postings(area_key, doc_id, changed, removed, length)
+
+    new_doc = SearchDocument(key_name=key_name, area_key=area_key,
+        doc_kind=kind, ref=ref, title=title, summary=(text or u'')[:300],
+        counts=counts, length=length)
+    new_doc.put()
+
+    if doc is None:
+        update_doc_count(area_key, 1)
+
+    return new_doc
+
+
+def unindex_document(area_key, kind, ref):
+    """Removes a document from the index.
+
+    :param area_key:
+        Key of the area where the document is published, as a string.
+    :param kind:
+        Document kind: 'wiki' or 'paste'.
+    :param ref:
+        Reference to the document: page path or paste id.
+    :return:
+        ``True`` if the document was removed, ``False`` if it wasn't indexed.
+    """
+    doc_id = get_doc_id(kind, ref)
+    doc = SearchDocument.get_by_key_name('%s:%s' % (area_key, doc_id))
+    if doc is None:
+        return False
+
+    update_postings(area_key, doc_id, {}, list(doc.counts or {}), None)
+    doc.delete()
+    update_doc_count(area_key, -1)
+    return True
+
+
+def add_index_task(area, kind, ref):
+    """Adds a task to index a document after it is saved.
+
+    :param area:
+        The :class:`moe.base.models.Area` where the document is published.
+    :param kind:
+        Document kind: 'wiki' or 'paste'.
+    :param ref:
+        Reference to the document: page path or paste id.
+    :return:
+        ``None``.
+    """
+    from google.appengine.api.labs import taskqueue
+    url = url_for('search/index-document', area_name=area.name)
+    taskqueue.add(url=url, params={'kind': kind, 'ref': ref})
+
+
+def update_postings(area_key, doc_id, changed, removed, length):
+    """Updates the posting lists of a document and its length. All of them
+    are in the entity group of the document shard, so they are updated with
+    batch gets and puts, up to :data:`POSTINGS_BATCH_SIZE` terms per
+    transaction.
+
+    :param area_key:
+        Key of the area where the document is published, as a string.
+    :param doc_id:
+        Document id, as returned by :func:`get_doc_id`.
+    :param changed:
+        A dictionary mapping terms to their new counts.
+    :param removed:
+        A list of terms no longer used by the document.
+    :param length:
+        Total count of terms of the document, or ``None`` if the document
+        is being removed.
+    :return:
+        ``None``.
+    """
+    shard_key = get_shard_key(area_key, get_shard(doc_id))
+    updates = changed.items() + [(term, None) for term in removed]
+
+    def txn(batch, update_length):
+        keys = [get_postings_key(shard_key, term) for term, count in batch]
+        if update_length:
+            keys.append(shard_key)
+
+        entities = db.get(keys)
+        to_put = []
+        to_delete = []
+
+        if update_length:
+            shard = entities.pop()
+            if shard is None:
+                shard = SearchShard(key_name=shard_key.name(), lengths={})
+
+            lengths = shard.lengths or {}
+            if length is None:
+                if lengths.pop(doc_id, None) is not None:
+                    to_put.append(shard)
+            elif lengths.get(doc_id) != length:
+                lengths[doc_id] = length
+                to_put.append(shard)
+
+            shard.lengths = lengths
+
+        for (term, count), entity in zip(batch, entities):
+            if entity is None:
+                if count is None:
+                    continue
+
+                entity = SearchPostings(parent=shard_key, key_name='t:' + term,
+                    postings={})
+
+            if count is None:
+                if entity.postings.pop(doc_id, None) is None:
+                    continue
+            elif entity.postings.get(doc_id) == count:
+                continue
+            else:
+                entity.postings[doc_id] = count
+
+            if entity.postings:
+                to_put.append(entity)
+            elif entity.is_saved():
+                to_delete.append(entity)
+
+        if to_put:
+            db.put(to_put)
+
+        if to_delete:
+            db.delete(to_delete)
+
+    # The length is updated with the first batch, even without terms.
+    batches = [updates[i:i + POSTINGS_BATCH_SIZE] for i in
+        range(0, len(updates), POSTINGS_BATCH_SIZE)] or [[]]
+    for i, batch in enumerate(batches):
+        db.run_in_transaction_custom_retries(10, txn, batch, i == 0)
+
+
+def update_doc_count(area_key, delta):
+    """Adds ``delta`` to the number of indexed documents in an area."""
+    def txn():
+        stats = SearchStats.get_by_key_name(area_key)
+        if stats is None:
+            stats = SearchStats(key_name=area_key)
+
+        stats.doc_count = max(stats.doc_count + delta, 0)
+        stats.put()
+
+    db.run_in_transaction(txn)
+
+
+def search(area_key, query_string, kind=None, cursor=None, limit=20):
+    """Searches documents in an area.
+
+    :param area_key:
+        Key of the area to search, as a string.
+    :param query_string:
+        The search query. Documents must contain all its terms.
+    :param kind:
+        Optional document kind to search: 'wiki' or 'paste'.
+    :param cursor:
+        A cursor returned by a previous call, or ``None`` to get the first
+        results.
+    :param limit:
+        Maximum number of results.
+    :return:
+        A tuple ``(documents, next_cursor, count)``, with a list of
+        :class:`SearchDocument` entities sorted by relevance, a cursor for
+        the next results or ``None``, and the total number of results.
+    """
+    terms = []
+    for term in tokenize(query_string):
+        if term not in terms:
+            terms.append(term)
+
+    terms = terms[:get_config('moe.search', 'max_query_terms')]
+    if not terms:
+        return [], None, 0
+
+    results = get_ranked_results(area_key, terms, kind)
+
+    start = 0
+    if cursor:
+        try:
+            score, doc_id = cursor.split(':', 1)
+            start = bisect.bisect_right(results, (float(score), doc_id))
+        except ValueError:
+            pass
+
+    page = results[start:start + limit]
+    next_cursor = None
+    if start + limit < len(results):
+        next_cursor = '%r:%s' % page[-1]
+
+    keys = [db.Key.from_path(SearchDocument.kind(),
+        '%s:%s' % (area_key, doc_id)) for score, doc_id in page]
+    documents = [doc for doc in db.get(keys) if doc is not None]
+    return documents, next_cursor, len(results)
+
+
+def get_ranked_results(area_key, terms, kind=None):
+    """Returns the documents that have all the given terms, ranked by
+    tf-idf. Results are cached for a while.
+
+    :param area_key:
+        Key of the area to search, as a string.
+    :param terms:
+        A list of normalized terms.
+    :param kind:
+        Optional document kind to search: 'wiki' or 'paste'.
+    :return:
+        A sorted list of tuples ``(-score, doc_id)``, with up to
+        :data:`MAX_RESULTS` items.
+    """
+    cache_key = get_results_cache_key(area_key, terms, kind)
+    results = memcache.get(cache_key)
+    if results is not None:
+        return results
+
+    shards = get_config('moe.search', 'posting_shards')
+    shard_keys = [get_shard_key(area_key, shard) for shard in range(shards)]
+    keys = [get_postings_key(shard_key, term) for term in terms
+        for shard_key in shard_keys]
+    keys.extend(shard_keys)
+    keys.append(db.Key.from_path(SearchStats.kind(), area_key))
+    entities = db.get(keys)
+    stats = entities.pop()
+
+    lengths = {}
+    for shard in entities[-shards:]:
+        if shard is not None and shard.lengths:
+            lengths.update(shard.lengths)
+
+    entities = entities[:-shards]
+    postings = []
+    for i in range(len(terms)):
+        merged = {}
+        for entity in entities[i * shards:(i + 1) * shards]:
+            if entity is not None:
+                merged.update(entity.postings)
+
+        postings.append(merged)
+
+    # Start from the rarest term to intersect the smallest sets.
+    postings.sort(key=len)
+    candidates = postings[0]
+    if kind is not None:
+        prefix = KIND_PREFIXES[kind] + ':'
+        candidates = [doc_id for doc_id in candidates
+            if doc_id.startswith(prefix)]
+
+    doc_count = max(stats and stats.doc_count or 0, len(postings[-1]), 1)
+    idfs = [math.log(1 + float(doc_count) / (len(p) or 1)) for p in postings]
+
+    scores = {}
+    for doc_id in candidates:
+        score = 0
+        for idf, p in zip(idfs, postings):
+            count = p.get(doc_id)
+            if count is None:
+                break
+
+            score += count * idf
+        else:
+            scores[doc_id] = score
+
+    # Normalize term frequencies by the length of the documents.
+    results = []
+    for doc_id, score in scores.iteritems():
+        norm = math.sqrt(lengths.get(doc_id) or 0) or 1
+        results.append((-round(score / norm, 6), doc_id))
+
+    results.sort()
+    results = results[:MAX_RESULTS]
+    memcache.set(cache_key, results,
+        time=get_config('moe.search', 'result_cache_time'))
+    return results
+
+
+def get_doc_id(kind, ref):
+    return '%s:%s' % (KIND_PREFIXES[kind], ref)
+
+
+def get_shard(doc_id):
+    shards = get_config('moe.search', 'posting_shards')
+    return int(hashlib.md5(doc_id.encode('utf-8')).hexdigest()[:8], 16) % \
+        shards
+
+
+def get_shard_key(area_key, shard):
+    return db.Key.from_path(SearchShard.kind(), '%s:%d' % (area_key, shard))
+
+
+def get_postings_key(shard_key, term):
+    return db.Key.from_path(SearchPostings.kind(), 't:' + term,
+        parent=shard_key)
+
+
+def get_results_cache_key(area_key, terms, kind):
+    key = '%s|%s|%s' % (area_key, kind, ' '.join(sorted(terms)))
+    return 'moe.search.results:' + hashlib.md5(key.encode('utf-8')).hexdigest()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+    moe.search.urls
+    ~~~~~~~~~~~~~~~
+
+    URL definitions.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+from tipfy import get_config, Rule
+
+
+def get_rules():
+    # Take the area name from the subdomain if they are in use. Otherwise
+    # assume that this will be used in a single domain.
+    if get_config('moe', 'use_subdomain', False):
+        kwargs = {'subdomain': '<area_name>'}
+    else:
+        kwargs = {'defaults': {'area_name': 'www'}}
+
+    rules = [
+        Rule('/', endpoint='search/index', handler='moe.search.handlers.SearchHandler', **kwargs),
+        Rule('/tasks/index', endpoint='search/index-document', handler='moe.search.handlers.SearchIndexTaskHandler', **kwargs),
+        # Build the index for existing content.
+        # Rule('/build-index/', endpoint='search/build-index', handler='moe.search.handlers.SearchIndexBuildHandler', **kwargs),
+    ]
+
+    return rules
@@ -10,10 +10,42 @@ from tipfy import get_config, cached_property
 #: - ``start_page``: Name of the start page. Default is 'start'.
 #: - ``max_path_depth``: Maximum number of path parts to be accepted in a URL.
 #:   Default is 5.
+#: - ``history_storage``: How past revisions are stored. 'full' stores a
+#:   complete copy of each revision; 'delta' stores reverse patches against
+#:   the next revision. Default is 'delta'.
+#: - ``history_keyframe_interval``: When using 'delta' storage, every
+#:   revision with a number multiple of this value is stored in full, so
+#:   rebuilding any version touches at most this number of entities.
+#:   Default is 10.
+#: - ``page_cache_size``: Maximum number of rendered pages kept in the memory
+#:   of each instance. Default is 200.
+#: - ``page_cache_time``: Time in seconds to keep rendered pages in memcache,
+#:   or 0 to keep them until they are evicted. Default is 0.
+#: - ``feed_cache_time``: Time in seconds to keep feeds in memcache. Default
+#:   is 3600.
+#: - ``feed_summary_length``: If greater than 0, feeds send a plain text
+#:   summary of each page with up to this number of characters instead of
+#:   the full page body. Default is 0.
+#: - ``tree_cache_time``: Time in seconds to keep the page tree of an area
+#:   in memcache. It is also removed when a page is created. Default is
+#:   86400.
+#: - ``reparse_shards``: Number of task chains run in parallel to reparse
+#:   outdated pages. Default is 8.
+#: - ``reparse_batch_size``: Number of pages reparsed and saved together by
+#:   each reparse task. Default is 50.
 default_config = {
-    'protected_path': 'pages',
-    'start_page':     'start',
-    'max_path_depth': 5,
+    'protected_path':            'pages',
+    'start_page':                'start',
+    'max_path_depth':            5,
+    'history_storage':           'delta',
+    'history_keyframe_interval': 10,
+    'page_cache_size':           200,
+    'page_cache_time':           0,
+    'feed_cache_time':           3600,
+    'feed_summary_length':       0,
+    'tree_cache_time':           86400,
+    'reparse_shards':            8,
+    'reparse_batch_size':        50,
 }
 
 
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+    moe.wiki.cache
+    ~~~~~~~~~~~~~~
+
+    Caches for rendered wiki pages and feeds.
+
+    Rendered pages have an in-process tier in front of memcache. Each page
+    has a token in memcache that changes whenever the page is saved. Cached
+    renders are stored with the token they were built with, and are only
+    served if it matches the current one, so saving a page invalidates its
+    renders in all instances.
+
+    Feeds are cached in memcache as lists of entries, which are updated in
+    place when a page is saved. Page trees are cached compressed in memcache
+    until a page is created, or for ``tree_cache_time``.
+
+    The progress of reparse jobs is kept in memcache counters.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import logging
+import pickle
+import uuid
+import zlib
+
+from google.appengine.api import memcache
+
+from tipfy import get_config
+
+from moe.base.cache import LRUCache
+
+#: Number of entries in feeds.
+FEED_LIMIT = 20
+
+#: Maximum size of a compressed page tree stored in memcache.
+MAX_TREE_SIZE = 1000000 - 1024
+
+#: In-process cache shared by all requests in this instance.
+_local_cache = None
+
+
+def get_local_cache():
+    global _local_cache
+    if _local_cache is None:
+        _local_cache = LRUCache(get_config('moe.wiki', 'page_cache_size'))
+
+    return _local_cache
+
+
+def get_rendered_page(key_name, version, locale):
+    """Returns a cached page render.
+
+    :param key_name:
+        Key name of the page, as returned by ``WikiPage.get_key_name()``.
+    :param version:
+        Page version, or ``None`` for the latest one.
+    :param locale:
+        Locale used to render the page.
+    :return:
+        A tuple ``(value, token)``. ``value`` is ``None`` if the page is not
+        cached; ``token`` must be passed to :func:`set_rendered_page`. The
+        token is created if the page has none, so it also identifies the
+        current render for HTTP validators.
+    """
+    cache_key = get_cache_key(key_name, version, locale)
+    token_key = get_token_key(key_name)
+
+    local_cache = get_local_cache()
+    cached = local_cache.get(cache_key)
+    if cached is not None:
+        token = memcache.get(token_key)
+    else:
+        res = memcache.get_multi([token_key, cache_key])
+        token = res.get(token_key)
+        cached = res.get(cache_key)
+        if cached is not None:
+            local_cache.set(cache_key, cached)
+
+    if token is not None and cached is not None and cached[0] == token:
+        return cached[1], token
+
+    if token is None:
+        token = uuid.uuid4().hex
+        if not memcache.add(token_key, token):
+            # Created meanwhile by another request.
+            token = memcache.get(token_key)
+
+    return None, token
+
+
+def set_rendered_page(key_name, version, locale, value, token):
+    """Caches a page render.
+
+    :param key_name:
+        Key name of the page, as returned by ``WikiPage.get_key_name()``.
+    :param version:
+        Page version, or ``None`` for the latest one.
+    :param locale:
+        Locale used to render the page.
+    :param value:
+        The value to be cached.
+    :param token:
+        The token returned by :func:`get_rendered_page` before the page was
+        loaded.
+    :return:
+        ``None``.
+    """
+    if token is None:
+        token = uuid.uuid4().hex
+        if not memcache.add(get_token_key(key_name), token):
+            # The page was saved meanwhile, so this render may be outdated.
+            return
+
+    cache_key = get_cache_key(key_name, version, locale)
+    cached = (token, value)
+    get_local_cache().set(cache_key, cached)
+    memcache.set(cache_key, cached,
+        time=get_config('moe.wiki', 'page_cache_time'))
+
+
+def invalidate_rendered_page(key_name):
+    """Invalidates all cached renders of a page.
+
+    :param key_name:
+        Key name of the page, as returned by ``WikiPage.get_key_name()``.
+    :return:
+        ``None``.
+    """
+    memcache.set(get_token_key(key_name), uuid.uuid4().hex)
+
+
+def invalidate_rendered_pages(key_names):
+    """Invalidates all cached renders of a list of pages.
+
+    :param key_names:
+        Key names of the pages, as returned by ``WikiPage.get_key_name()``.
+    :return:
+        ``None``.
+    """
+    if key_names:
+        memcache.set_multi(dict((get_token_key(key_name), uuid.uuid4().hex)
+            for key_name in key_names))
+
+
+def get_cache_key(key_name, version, locale):
+    return 'moe.wiki.page:%s:%s:%s' % (key_name, version or 'latest', locale)
+
+
+def get_token_key(key_name):
+    return 'moe.wiki.page-token:%s' % key_name
+
+
+def get_feed_cache_key(name, *args):
+    """Returns the memcache key for a feed.
+
+    :param name:
+        Feed name: 'changes', 'page-changes' or 'list'.
+    :param args:
+        Values identifying the feed, such as area key or page path.
+    :return:
+        A memcache key.
+    """
+    return 'moe.wiki.feed:%s:%s' % (name, ':'.join(str(arg) for arg in args))
+
+
+def get_cached_feed(cache_key):
+    """Returns the list of entries for a cached feed, or ``None``."""
+    return memcache.get(cache_key)
+
+
+def set_cached_feed(cache_key, entries):
+    """Caches the list of entries for a feed."""
+    memcache.set(cache_key, entries,
+        time=get_config('moe.wiki', 'feed_cache_time'))
+
+
+def prepend_feed_entry(cache_key, entry, update=None):
+    """Adds an entry to the top of a cached feed, dropping the oldest ones
+    beyond :data:`FEED_LIMIT`. Nothing happens if the feed is not cached.
+
+    :param cache_key:
+        Memcache key for the feed.
+    :param entry:
+        The new entry.
+    :param update:
+        Optional function called for each existing entry, returning the entry
+        to keep in its place or ``None`` to drop it.
+    :return:
+        ``None``.
+    """
+    def func(entries):
+        if update is not None:
+            entries = [e for e in (update(e) for e in entries)
+                if e is not None]
+
+        entries.insert(0, entry)
+        return entries[:FEED_LIMIT]
+
+    update_cached_feed(cache_key, func)
+
+
+def replace_feed_entry(cache_key, entry, match):
+    """Replaces an entry in a cached feed. If no entry matches, the feed is
+    removed from cache, as the entry position is unknown.
+
+    :param cache_key:
+        Memcache key for the feed.
+    :param entry:
+        The new entry.
+    :param match:
+        A function that returns ``True`` for the entry to be replaced.
+    :return:
+        ``None``.
+    """
+    def func(entries):
+        for i, existing in enumerate(entries):
+            if match(existing):
+                entries[i] = entry
+                return entries
+
+    update_cached_feed(cache_key, func)
+
+
+def update_cached_feed(cache_key, func, retries=3):
+    """Updates a cached feed with compare-and-set, so that concurrent
+    updates don't overwrite each other. If the feed keeps changing
+    meanwhile, it is removed from cache. Nothing happens if the feed is not
+    cached.
+
+    :param cache_key:
+        Memcache key for the feed.
+    :param func:
+        A function called with the list of entries, returning the new list or
+        ``None`` to remove the feed from cache.
+    :param retries:
+        Number of times to try to set the feed.
+    :return:
+        ``None``.
+    """
+    client = memcache.Client()
+    for i in range(retries):
+        entries = client.gets(cache_key)
+        if entries is None:
+            return
+
+        entries = func(entries)
+        if entries is None:
+            break
+
+        if client.cas(cache_key, entries,
+            time=get_config('moe.wiki', 'feed_cache_time')):
+            return
+
+    memcache.delete(cache_key)
+
+
+def delete_cached_feeds(area_key, key_name, parent_path):
+    """Removes from cache all feeds that may include a given page.
+
+    :param area_key:
+        Key of the page area, as a string.
+    :param key_name:
+        Key name of the page.
+    :param parent_path:
+        Parent path of the page.
+    :return:
+        ``None``.
+    """
+    memcache.delete_multi([
+        get_feed_cache_key('changes', area_key),
+        get_feed_cache_key('page-changes', key_name),
+        get_feed_cache_key('list', area_key, parent_path),
+    ])
+
+
+def get_cached_tree(area_key):
+    """Returns the cached page tree for an area, or ``None``."""
+    value = memcache.get(get_tree_cache_key(area_key))
+    if value is not None:
+        return pickle.loads(zlib.decompress(value))
+
+
+def set_cached_tree(area_key, tree):
+    """Caches the page tree for an area, compressed. Trees too large for
+    memcache are not cached.
+    """
+    value = zlib.compress(pickle.dumps(tree, pickle.HIGHEST_PROTOCOL))
+    if len(value) > MAX_TREE_SIZE:
+        logging.warning('Page tree for %s is too large to be cached (%d '
+            'bytes).', area_key, len(value))
+        return
+
+    memcache.set(get_tree_cache_key(area_key), value,
+        time=get_config('moe.wiki', 'tree_cache_time'))
+
+
+def invalidate_page_tree(area_key):
+    """Removes the cached page tree for an area."""
+    memcache.delete(get_tree_cache_key(area_key))
+
+
+def get_tree_cache_key(area_key):
+    return 'moe.wiki.tree:%s' % area_key
+
+
+def get_reparse_progress(job):
+    """Returns the progress of a reparse job.
+
+    :param job:
+        The job id.
+    :return:
+        A dictionary with the number of ``shards``, ``shards_done``, pages
+        ``checked`` and pages ``reparsed``, or ``None`` if the job is not
+        known.
+    """
+    names = ('shards', 'shards_done', 'checked', 'reparsed')
+    progress = memcache.get_multi(names,
+        key_prefix=get_reparse_cache_key(job, ''))
+    if len(progress) < len(names):
+        return None
+
+    return progress
+
+
+def get_reparse_cache_key(job, name):
+    return 'moe.wiki.reparse:%s:%s' % (job, name)
@@ -9,23 +9,49 @@
     :license: BSD, see LICENSE.txt for more details.
 """
 import difflib
+import logging
+import uuid
 
 import diff_match_patch
 
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
 from werkzeug import escape, url_quote_plus
 from werkzeug.contrib.atom import AtomFeed
 
-from tipfy import (abort, get_config, escape, redirect, redirect_to, url_for)
-from tipfy.ext.i18n import _, ngettext
+from tipfy import (abort, get_config, escape, redirect, redirect_to, url_for,
+    Response)
+from tipfy.ext.i18n import _, get_locale, ngettext
 from tipfy.ext.auth import user_required, get_current_user
 from tipfy.ext.db import _slugify
+from tipfy.ext.jinja2 import render_template
 
 from moe.base.handlers import AreaRequestHandler
+from moe.base.models import get_area
+from moe.base.properties import compress_entities
 from moe.wiki import WikiPath
-from moe.wiki.models import (WikiPage, wiki_list_pager, WikiRevision,
-    WikiRevisionForm, wiki_changes_pager, wiki_list_pager,
-    wiki_revisions_pager)
-from moe.wiki.parser import get_page_sections, parse_page
+from moe.search.models import index_document
+from moe.wiki.cache import (FEED_LIMIT, delete_cached_feeds, get_cached_feed,
+    get_feed_cache_key, get_rendered_page, get_reparse_cache_key,
+    get_reparse_progress, invalidate_rendered_pages, set_cached_feed,
+    set_rendered_page)
+from moe.wiki.models import (WikiPage, WikiRevision, WikiRevisionForm,
+    get_feed_entry, get_page_tree, wiki_backlinks_pager, wiki_changes_pager,
+    wiki_list_pager, wiki_revisions_pager, wiki_subtree_pager)
+from moe.wiki.parser import (get_page_environ, get_page_section,
+    get_page_sections, get_parser_fingerprint, get_section_index,
+    mark_missing_links, parse_page_sections, replace_page_section)
+
+
+def get_revision_section_index(revision):
+    """Returns the section index of a revision, building it if the revision
+    was saved before section indexes were stored.
+    """
+    if revision.section_index is None:
+        return get_section_index(revision.body_raw, revision.title)
+
+    return revision.section_index
 
 
 class WikiMiddleware(object):
@@ -114,6 +140,12 @@ class WikiBaseHandler(AreaRequestHandler):
             # home -> wiki -> all pages -> ...page path...
             self.add_breadcrumb('wiki/list', _('All Pages'))
             self.add_path_breadcrumb('wiki/list')
+        elif page == 'backlinks':
+            # Pages linking to a page
+            # home -> wiki -> ...page path... -> what links here
+            self.add_path_breadcrumb('wiki/index')
+            self.add_breadcrumb('wiki/backlinks', _('What links here'),
+                **kwargs)
         elif page == 'pages':
             # Internal page namespace.
             # home -> wiki -> pages
@@ -133,19 +165,92 @@ class WikiBaseHandler(AreaRequestHandler):
             kwargs['page_path'] = path
             self.add_breadcrumb(endpoint, name, **kwargs)
 
+    def feed_response(self, title, url, entries):
+        """Returns an Atom feed response.
+
+        :param title:
+            Feed title, without the site name.
+        :param url:
+            URL of the HTML page for the feed.
+        :param entries:
+            List of feed entries, as returned by
+            :func:`moe.wiki.models.get_feed_entry`.
+        :return:
+            A response with the feed, or a "304 Not Modified" response if
+            the client has a current copy.
+        """
+        if entries:
+            updated = max(entry['updated'] for entry in entries)
+            key = '|'.join('%s:%s:%s' % (e['path'], e['version'],
+                e['updated'].isoformat()) for e in entries)
+            response = self.check_not_modified(key, last_modified=updated,
+                private=False)
+            if response is not None:
+                return response
+        else:
+            updated = None
+
+        sitename = get_config('moe', 'sitename')
+        feed = AtomFeed(title + ' - ' + sitename, feed_url=self.request.url,
+                        url=url, generator=(sitename, None, None),
+                        updated=updated)
+
+        for entry in entries:
+            url_kwargs = {'area_name': self.area.name,
+                'page_path': entry['path']}
+            if entry['version'] is not None:
+                url_kwargs['version'] = entry['version']
+
+            feed.add(entry['title'], entry['content'],
+                     content_type='html',
+                     summary=entry['summary'],
+                     summary_type='text',
+                     author=entry['author'],
+                     url=url_for('wiki/index', **url_kwargs),
+                     updated=entry['updated'],
+                     published=entry['published'],
+                     xml_base=self.request.url_root)
+
+        return self.set_validators(feed.get_response())
+
 
 class WikiViewHandler(WikiBaseHandler):
-    """Displays a wiki page."""
+    """Displays a wiki page. The page contents are rendered separately and
+    cached until the page is saved again.
+    """
     def get(self, **kwargs):
         page_name = self.wiki_path.page_name
         page_path = self.wiki_path.normalized_path
         version = self.request.args.get('version', None, type=int)
 
-        revision = WikiPage.get_revision(self.area, page_path, version)
+        key_name = WikiPage.get_key_name(self.area, page_path)
+        locale = get_locale()
+        page, token = get_rendered_page(key_name, version, locale)
+        if page is None:
+            revision = WikiPage.get_revision(self.area, page_path, version)
 
-        if version and not revision:
-            # Bad request.
-            abort(404)
+            if version and not revision:
+                # Bad request.
+                abort(404)
+
+            updated = revision and revision.updated
+        else:
+            revision = None
+            updated = page['updated']
+
+        if updated:
+            # The token changes when linked pages are created or deleted, as
+            # links to missing pages are rendered differently.
+            response = self.check_not_modified('%s|%s|%s|%s|%s' % (page_path,
+                version, updated.isoformat(), get_parser_fingerprint(),
+                token), last_modified=updated)
+            if response is not None:
+                return response
+
+        if page is None:
+            page = self.render_page(revision, page_name, page_path, version)
+            if revision:
+                set_rendered_page(key_name, version, locale, page, token)
 
         self.set_breadcrumbs(page='view')
         if version:
@@ -154,6 +259,30 @@ class WikiViewHandler(WikiBaseHandler):
                 version=version)
 
         context = {
+            'page_name':    page_name,
+            'page_path':    page_path,
+            'version':      version,
+            'page_title':   page['title'],
+            'page_content': page['content'],
+            'page_toc':     page['toc'],
+            'page_exists':  page['updated'] is not None,
+            'title_quoted': url_quote_plus(page['title']),
+            'current_url_quoted': url_quote_plus(url_for('wiki/index',
+                full=True, area_name=self.area.name, page_path=page_path,
+                version=version)),
+        }
+        return self.render_response('wiki/page_view.html', **context)
+
+    def render_page(self, revision, page_name, page_path, version):
+        """Renders the contents of a page.
+
+        :return:
+            A dictionary with the page ``title``, the rendered ``content``,
+            the ``toc`` and the ``updated`` date, which is ``None`` if the
+            page doesn't exist.
+        """
+        context = {
+            'area':      self.area,
             'page_name': page_name,
             'page_path': page_path,
             'revision':  revision,
@@ -161,13 +290,32 @@ class WikiViewHandler(WikiBaseHandler):
         }
 
         if revision:
+            url = url_for('wiki/index', full=True, area_name=self.area.name,
+                page_path=page_path, version=version)
             context.update({
                 'slug': _slugify(revision.title, default='heading'),
                 'title_quoted': url_quote_plus(revision.title),
-                'current_url_quoted': url_quote_plus(self.request.url),
+                'current_url_quoted': url_quote_plus(url),
             })
+            title = revision.title
+            toc = revision.toc
+        else:
+            title = page_name
+            toc = None
 
-        return self.render_response('wiki/page_view.html', **context)
+        content = render_template('wiki/_page_content.html', **context)
+        if revision and not version:
+            page = WikiPage.get_page(self.area, page_path)
+            if page and page.links:
+                content = mark_missing_links(content, self.area,
+                    WikiPage.get_missing_links(self.area, page.links))
+
+        return {
+            'title':   title,
+            'content': content,
+            'toc':     toc,
+            'updated': revision and revision.updated or None,
+        }
 
 
 class WikiOverviewHandler(WikiBaseHandler):
@@ -192,59 +340,68 @@ class WikiPageListHandler(WikiBaseHandler):
         else:
             page_name = page_path = revision = None
 
-        curr_cursor = self.request.args.get('start')
-        pages, cursor = wiki_list_pager(self.area, parent_path=page_path,
-            cursor=curr_cursor)
+        cursor = self.request.args.get('start')
+        show_all = bool(page_path and self.request.args.get('all'))
+        if show_all:
+            pager = wiki_subtree_pager(self.area, page_path, cursor=cursor)
+        else:
+            pager = wiki_list_pager(self.area, parent_path=page_path,
+                cursor=cursor)
 
         return {
             'page_name':     page_name,
             'page_path':     page_path,
             'revision':      revision,
-            'pages':         pages,
-            'is_first_page': curr_cursor is None,
-            'next_page':     cursor,
+            'show_all':      show_all,
+            'pages':         pager.entities,
+            'is_first_page': pager.is_first_page,
+            'next_page':     pager.next_cursor,
+            'prev_page':     pager.prev_cursor,
         }
 
     def get(self, **kwargs):
         self.set_breadcrumbs(page='list')
         return self.render_response('wiki/page_list.html',
-            **self.get_context())
+            page_tree=get_page_tree(self.area), **self.get_context())
 
 
 class WikiPageListFeedHandler(WikiPageListHandler):
     """Displays a list with all content pages (Atom format)."""
     def get(self, **kwargs):
-        """TODO: cache."""
-        context = self.get_context()
+        if self.wiki_path:
+            page_name = self.wiki_path.page_name
+            page_path = self.wiki_path.normalized_path
+        else:
+            page_name = page_path = None
+
+        cursor = self.request.args.get('start')
+        cache_key = get_feed_cache_key('list', self.area.key(), page_path)
+        entries = None
+        if cursor is None:
+            entries = get_cached_feed(cache_key)
+
+        if entries is None:
+            if page_path and not WikiPage.get_revision(self.area, page_path):
+                abort(404)
+
+            pager = wiki_list_pager(self.area, parent_path=page_path,
+                cursor=cursor, limit=FEED_LIMIT, with_revisions=True)
+            entries = [get_feed_entry(revision, page.path) for page, revision
+                in pager.entities]
+            if cursor is None:
+                set_cached_feed(cache_key, entries)
 
         url_kwargs = {'area_name': self.area.name}
 
-        if context.get('page_path'):
+        if page_path:
             page_title = _('All pages in %(page_name)s',
-                page_name=escape(context.get('page_name')))
-            url_kwargs['page_path'] = context.get('page_path')
+                page_name=escape(page_name))
+            url_kwargs['page_path'] = page_path
         else:
             page_title = _('All Pages')
 
-        sitename = get_config('moe', 'sitename')
-        page_title += ' - ' + sitename
         url = url_for('wiki/list', full=True, **url_kwargs)
-        generator = (sitename, None, None)
-        feed = AtomFeed(page_title, feed_url=self.request.url, url=url,
-                        generator=generator)
-
-        for page in context.get('pages'):
-            revision = page.latest_revision
-            feed.add(revision.title, unicode(revision.body),
-                     content_type='html',
-                     author=revision.editor.username,
-                     url=url_for('wiki/index', area_name=self.area.name,
-                                 page_path=page.path),
-                     updated=revision.updated,
-                     published=revision.created,
-                     xml_base=self.request.url_root)
-
-        return feed.get_response()
+        return self.feed_response(page_title, url, entries)
 
 
 class WikiChangesHandler(WikiBaseHandler):
@@ -252,13 +409,14 @@ class WikiChangesHandler(WikiBaseHandler):
     def get(self, **kwargs):
         self.set_breadcrumbs(page='changes')
 
-        curr_cursor = self.request.args.get('start')
-        entities, cursor = wiki_changes_pager(self.area, cursor=curr_cursor)
+        pager = wiki_changes_pager(self.area,
+            cursor=self.request.args.get('start'))
 
         context = {
-            'pages': entities,
-            'is_first_page': curr_cursor is None,
-            'next_page': cursor,
+            'pages':         pager.entities,
+            'is_first_page': pager.is_first_page,
+            'next_page':     pager.next_cursor,
+            'prev_page':     pager.prev_cursor,
         }
         return self.render_response('wiki/latest_changes.html', **context)
 
@@ -266,32 +424,22 @@ class WikiChangesHandler(WikiBaseHandler):
 class WikiChangesFeedHandler(WikiBaseHandler):
     """Displays lists of recent changes in the whole wiki."""
     def get(self, **kwargs):
-        curr_cursor = self.request.args.get('start')
-        pages, cursor = wiki_changes_pager(self.area, cursor=curr_cursor)
-        if pages is None:
-            pages = []
+        cursor = self.request.args.get('start')
+        cache_key = get_feed_cache_key('changes', self.area.key())
+        entries = None
+        if cursor is None:
+            entries = get_cached_feed(cache_key)
+
+        if entries is None:
+            pager = wiki_changes_pager(self.area, cursor=cursor,
+                limit=FEED_LIMIT, with_revisions=True)
+            entries = [get_feed_entry(revision, page.path) for page, revision
+                in pager.entities]
+            if cursor is None:
+                set_cached_feed(cache_key, entries)
 
-        sitename = get_config('moe', 'sitename')
-        page_title = _('Latest Changes')
-        page_title += ' - ' + sitename
         url = url_for('wiki/changes', full=True, area_name=self.area.name)
-        generator = (sitename, None, None)
-
-        feed = AtomFeed(page_title, feed_url=self.request.url, url=url,
-                        generator=generator)
-
-        for page in pages:
-            revision = page.latest_revision
-            feed.add(revision.title, unicode(revision.body),
-                     content_type='html',
-                     author=revision.editor.username,
-                     url=url_for('wiki/index', area_name=self.area.name,
-                         page_path=page.path),
-                     updated=revision.updated,
-                     published=revision.created,
-                     xml_base=self.request.url_root)
-
-        return feed.get_response()
+        return self.feed_response(_('Latest Changes'), url, entries)
 
 
 class WikiPageChangesHandler(WikiBaseHandler):
@@ -308,16 +456,17 @@ class WikiPageChangesHandler(WikiBaseHandler):
         if not revision:
             abort(404)
 
-        curr_cursor = self.request.args.get('start')
-        revisions, cursor = wiki_revisions_pager(revision, cursor=curr_cursor)
+        pager = wiki_revisions_pager(revision,
+            cursor=self.request.args.get('start'))
 
         return {
             'page_name':     page_name,
             'page_path':     page_path,
-            'revisions':     revisions,
+            'revisions':     pager.entities,
             'revision':      revision,
-            'is_first_page': curr_cursor is None,
-            'next_page':     cursor,
+            'is_first_page': pager.is_first_page,
+            'next_page':     pager.next_cursor,
+            'prev_page':     pager.prev_cursor,
         }
 
     def get(self, **kwargs):
@@ -334,34 +483,37 @@ class WikiPageChangesHandler(WikiBaseHandler):
 class WikiPageChangesFeedHandler(WikiPageChangesHandler):
     """Displays lists of recent changes for a given page."""
     def get(self, **kwargs):
-        context = self.get_context()
-
-        url_kwargs = {
-            'area_name': self.area.name,
-            'page_path': context.get('page_path'),
-        }
-
-        sitename = get_config('moe', 'sitename')
-        page_title = _('History for %(page_name)s', page_name= escape(
-            context.get('revision').title))
-        page_title += ' - ' + sitename
-        url = url_for('wiki/changes', full=True, **url_kwargs)
-        generator = (sitename, None, None)
-
-        feed = AtomFeed(page_title, feed_url=self.request.url, url=url,
-                        generator=generator)
-
-        for revision in context.get('revisions'):
-            feed.add(revision.title, unicode(revision.body),
-                     content_type='html',
-                     author=revision.editor.username,
-                     url=url_for('wiki/index', version=revision.version.lower(),
-                         **url_kwargs),
-                     updated=revision.updated,
-                     published=revision.created,
-                     xml_base=self.request.url_root)
+        page_path = self.wiki_path.normalized_path
+        cursor = self.request.args.get('start')
+        cache_key = get_feed_cache_key('page-changes',
+            WikiPage.get_key_name(self.area, page_path))
+        entries = None
+        if cursor is None:
+            entries = get_cached_feed(cache_key)
+
+        if entries is None:
+            revisions = WikiRevision.restore_history(
+                self.get_context().get('revisions'))
+            entries = []
+            for revision in revisions:
+                if revision.parent_key() is None:
+                    version = None
+                else:
+                    version = revision.id
+
+                entries.append(get_feed_entry(revision, page_path, version))
+
+            if cursor is None:
+                set_cached_feed(cache_key, entries)
+
+        if not entries:
+            abort(404)
 
-        return feed.get_response()
+        page_title = _('History for %(page_name)s', page_name=escape(
+            entries[0]['title']))
+        url = url_for('wiki/changes', full=True, area_name=self.area.name,
+            page_path=page_path)
+        return self.feed_response(page_title, url, entries)
 
 
 class WikiDiffHandler(WikiBaseHandler):
@@ -496,9 +648,9 @@ class WikiEditHandler(WikiBaseHandler):
             section = self.request.args.get('section', None, type=int)
             if section is not None:
                 # Edit only part of the page, starting at a heading.
-                sections = get_page_sections(revision.body_raw)
                 try:
-                    body = sections[section]
+                    body = get_page_section(revision.body_raw, section,
+                        get_revision_section_index(revision))
                 except IndexError, e:
                     abort(404, _('Invalid page section.'))
             else:
@@ -539,28 +691,34 @@ class WikiEditHandler(WikiBaseHandler):
                 version)
 
             if body_raw or section is not None:
-                slug = _slugify(title, default=u'heading')
-                environ = {
-                    'headings': [slug],
-                    'toc':      [('h1', escape(title), slug)],
-                }
+                environ = get_page_environ(title)
 
                 if section is not None:
                     # Only part of the body was submitted.
                     if revision:
-                        sections = get_page_sections(revision.body_raw)
-                    else:
-                        sections = ['']
-
-                    try:
-                        sections.pop(section)
-                        sections.insert(section, body_raw)
-                        body_raw = u'\n\n'.join(sections)
-                    except IndexError, e:
+                        try:
+                            body_raw = replace_page_section(revision.body_raw,
+                                section, body_raw,
+                                get_revision_section_index(revision))
+                        except IndexError, e:
+                            abort(404, _('Invalid page section.'))
+                    elif section != 0:
                         abort(404, _('Invalid page section.'))
 
+                section_index = get_section_index(body_raw, title)
+
+                # Reuse the render of sections that didn't change.
+                if revision and revision.parser_version == \
+                    get_parser_fingerprint():
+                    cache = revision.section_cache
+                    cached_body = revision.body
+                else:
+                    cache = cached_body = None
+
                 try:
-                    body, toc = parse_page(body_raw, environ, self.area)
+                    body, toc, section_cache = parse_page_sections(
+                        get_page_sections(body_raw, section_index), environ,
+                        self.area, cache, cached_body)
                 except:
                     # Probably syntax errors. Render the form again.
                     self.set_message('error', _("Ooops. There are syntax "
@@ -571,12 +729,14 @@ class WikiEditHandler(WikiBaseHandler):
             else:
                 # Don't parse anything.
                 body, toc = '', ''
+                environ = {}
+                section_cache = section_index = None
 
             if revision is not None and (revision.body_raw == body_raw) and \
                 (revision.title == title):
                 # Nothing changed.
-                return self.success(_('Nothing changed.'), environ, page_path,
-                    section)
+                return self.success(_('Nothing changed.'), page_path,
+                    section, section_index)
 
             # Values for the revision.
             rev_values = {
@@ -588,20 +748,24 @@ class WikiEditHandler(WikiBaseHandler):
                 'toc':        toc,
                 'notes':      note,
                 'format':     'creole',
+                'parser_version': get_parser_fingerprint(),
+                'section_cache': section_cache,
+                'section_index': section_index,
             }
 
             # Values for the page.
             page_values = {
                 'parent_path': parent_path,
                 'parent_paths': parent_paths,
+                'links': environ.get('links', []),
             }
 
             try:
                 # Create or update page and revision.
                 WikiRevision.update(self.area, page_path, **rev_values)
                 WikiPage.update(self.area, page_path, **page_values)
-                return self.success(_('Page saved.'), environ, page_path,
-                    section)
+                return self.success(_('Page saved.'), page_path, section,
+                    section_index)
             except:
                 self.set_message('error', _('Ooops. A problem occurred '
                     'trying to save the page. Please make a backup of your '
@@ -612,15 +776,15 @@ class WikiEditHandler(WikiBaseHandler):
         self.set_form_error()
         return self._render_response()
 
-    def success(self, message, environ, page_path, section):
+    def success(self, message, page_path, section, section_index):
         # Success. Redirect to the saved page.
         self.set_message('success', message, flash=True)
 
         anchor = None
-        if section is not None:
+        if section and section_index:
             try:
-                # Add an anchor.
-                anchor = environ.get('toc')[section][2]
+                # Add an anchor to the heading that starts the section.
+                anchor = section_index[section - 1][2]
             except IndexError:
                 # Section was removed, so don't use anchor.
                 pass
@@ -639,6 +803,26 @@ class WikiEditHandler(WikiBaseHandler):
         return self.render_response('wiki/page_edit.html', **context)
 
 
+class WikiBacklinksHandler(WikiBaseHandler):
+    """Displays a list of pages linking to a page."""
+    def get(self, **kwargs):
+        page_name = self.wiki_path.page_name
+        page_path = self.wiki_path.normalized_path
+        pager = wiki_backlinks_pager(self.area, page_path,
+            cursor=self.request.args.get('start'))
+
+        self.set_breadcrumbs(page='backlinks')
+        context = {
+            'page_name':     page_name,
+            'page_path':     page_path,
+            'pages':         pager.entities,
+            'is_first_page': pager.is_first_page,
+            'next_page':     pager.next_cursor,
+            'prev_page':     pager.prev_cursor,
+        }
+        return self.render_response('wiki/backlinks.html', **context)
+
+
 class WikiEditOverviewHandler(WikiBaseHandler):
     def get(self, **kwargs):
         self.set_breadcrumbs(page='edit')
@@ -652,35 +836,228 @@ class WikiDiffOverviewHandler(WikiBaseHandler):
 
 
 class WikiReparseHandler(WikiBaseHandler):
-    """Reparse all pages."""
+    """Reparses the latest revision of pages that were parsed with an older
+    parser setup, as identified by :func:`get_parser_fingerprint`.
+
+    A request without parameters starts a job: it splits the pages in key
+    ranges and starts a chain of tasks for each range. The ``area`` argument
+    limits the job to the current area. Each task reparses a batch of pages
+    and saves them together. Progress is kept in memcache and can be seen
+    with a ``GET`` request with the ``job`` argument.
+    """
     def get(self, **kwargs):
-        return self.post(**kwargs)
+        job = self.request.args.get('job')
+        if job is None:
+            return self.post(**kwargs)
+
+        progress = get_reparse_progress(job)
+        if progress is None:
+            abort(404)
+
+        return Response('%(shards_done)d/%(shards)d shards done, '
+            '%(checked)d pages checked, %(reparsed)d reparsed.\n' %
+            progress, mimetype='text/plain')
 
     def post(self, **kwargs):
+        job = self.request.form.get('job')
+        if job is None:
+            return self.start_job()
+
+        # Continue a shard of the job.
+        shard = self.request.form.get('shard')
+        start = db.Key(self.request.form.get('start'))
+        end = db.Key(self.request.form.get('end'))
         cursor = self.request.form.get('cursor')
-        query = WikiRevision.all().order('updated')
+
+        query = WikiPage.all().filter('__key__ >=', start) \
+                              .filter('__key__ <', end) \
+                              .order('__key__')
         if cursor is not None:
             query.with_cursor(cursor)
 
-        entities = query.fetch(5)
-        if entities:
-            import google.appengine.api.labs.taskqueue
-
-            # Reparse all.
-            for entity in entities:
-                slug = _slugify(entity.title, default=u'heading')
-                environ = {
-                    'headings': [slug],
-                    'toc':      [('h1', escape(entity.title), slug)],
-                }
-                body, toc = parse_page(entity.body_raw, environ, self.area)
-                entity.body = body
-                entity.toc = toc
-                entity.save()
-
-            # Set a task to reparse next ones.
-            from google.appengine.api.labs import taskqueue
-            url = url_for('wiki/reparse', area_name=self.area.name)
-            taskqueue.add(url=url, params={'cursor': query.cursor()})
+        limit = get_config('moe.wiki', 'reparse_batch_size')
+        pages = query.fetch(limit)
+        reparsed = self.reparse_pages(pages)
+        memcache.incr(get_reparse_cache_key(job, 'checked'), len(pages))
+        memcache.incr(get_reparse_cache_key(job, 'reparsed'), reparsed)
+
+        if len(pages) < limit:
+            # This shard is done.
+            shards_done = memcache.incr(get_reparse_cache_key(job,
+                'shards_done'))
+            logging.info('Reparse job %s: shard %s done (%s shards done).',
+                job, shard, shards_done)
+            return ''
+
+        self.add_task(job=job, shard=shard, start=str(start), end=str(end),
+            cursor=query.cursor())
+        return ''
+
+    def start_job(self):
+        """Splits all pages in key ranges of similar size and starts a chain
+        of tasks for each one. Split points are taken from a random sample of
+        keys, using the ``__scatter__`` property set by the datastore, so
+        that pages don't need to be counted.
+        """
+        if self.request.values.get('area'):
+            # Key names of pages start with the area key.
+            prefix = str(self.area.key()) + ':'
+            start = db.Key.from_path(WikiPage.kind(), prefix)
+            end = db.Key.from_path(WikiPage.kind(), prefix[:-1] + ';')
+        else:
+            start = db.Key.from_path(WikiPage.kind(), u'\x00')
+            end = db.Key.from_path(WikiPage.kind(), u'\ufffd')
+
+        shards = get_config('moe.wiki', 'reparse_shards')
+        sample = WikiPage.all(keys_only=True).order('__scatter__') \
+                                             .fetch(shards * 32)
+        keys = sorted(key for key in sample if start <= key < end)
+
+        shards = max(min(shards, len(keys)), 1)
+        bounds = [start] + [keys[i * len(keys) // shards] for i in
+            range(1, shards)] + [end]
+
+        job = uuid.uuid4().hex[:8]
+        memcache.set_multi({
+            'shards':      shards,
+            'shards_done': 0,
+            'checked':     0,
+            'reparsed':    0,
+        }, key_prefix=get_reparse_cache_key(job, ''), time=86400)
+
+        for i in range(shards):
+            self.add_task(job=job, shard=i, start=str(bounds[i]),
+                end=str(bounds[i + 1]))
+
+        logging.info('Reparse job %s: %d shards.', job, shards)
+        return Response(url_for('wiki/reparse', area_name=self.area.name,
+            job=job) + '\n', mimetype='text/plain')
+
+    def reparse_pages(self, pages):
+        """Reparses the latest revisions of a list of pages if they are
+        outdated, and saves them with the patches of their previous revisions
+        rebuilt against the new text. Cached feeds with the pages are removed,
+        and the pages are indexed again for search.
+
+        :param pages:
+            A list of :class:`WikiPage` entities.
+        :return:
+            The number of revisions reparsed.
+        """
+        fingerprint = get_parser_fingerprint()
+        revisions = WikiRevision.get_by_key_name([page.key().name() for
+            page in pages])
+
+        to_put = []
+        reparsed = []
+        areas = {}
+        for page, revision in zip(pages, revisions):
+            if revision is None or revision.parser_version == fingerprint:
+                continue
+
+            area = areas.get(page.area_key)
+            if area is None:
+                area = areas[page.area_key] = get_area(
+                    db.Key(page.area_key).name())
+
+            old_values = revision.get_text_dict()
+            environ = get_page_environ(revision.title)
+            revision.section_index = get_section_index(revision.body_raw,
+                revision.title)
+            revision.body, revision.toc, revision.section_cache = \
+                parse_page_sections(get_page_sections(revision.body_raw,
+                revision.section_index), environ, area)
+            revision.parser_version = fingerprint
+            if not WikiRevision.save_rewritten(revision, old_values):
+                # Edited meanwhile, so it was parsed with the current setup.
+                continue
+
+            reparsed.append((page, revision))
+            if page.links != environ['links']:
+                page.links = environ['links']
+                to_put.append(page)
+
+        if to_put:
+            db.put(to_put)
+
+        if reparsed:
+            invalidate_rendered_pages([page.key().name() for page, revision
+                in reparsed])
+
+        for page, revision in reparsed:
+            delete_cached_feeds(page.area_key, page.key().name(),
+                page.parent_path)
+            index_document(page.area_key, 'wiki', page.path, revision.title,
+                revision.body_raw)
+
+        return len(reparsed)
+
+    def add_task(self, **params):
+        from google.appengine.api.labs import taskqueue
+        url = url_for('wiki/reparse', area_name=self.area.name)
+        taskqueue.add(url=url, params=params)
+
+
+class WikiHistoryMigrationHandler(WikiBaseHandler):
+    """Converts the history of all pages to the configured history storage,
+    one page at a time and a batch of revisions per task.
+    """
+    def get(self, **kwargs):
+        return self.post(**kwargs)
+
+    def post(self, **kwargs):
+        cursor = self.request.form.get('cursor')
+        key_name = self.request.form.get('key_name')
+        following_key = self.request.form.get('following_key')
+
+        if not key_name:
+            # Start converting the next page.
+            query = WikiPage.all(keys_only=True)
+            if cursor is not None:
+                query.with_cursor(cursor)
+
+            page_key = query.get()
+            if page_key is None:
+                # All done.
+                return ''
+
+            cursor = query.cursor()
+            key_name = page_key.name()
+            following_key = None
+
+        following_key = WikiRevision.migrate_history(key_name, following_key)
+
+        params = {'cursor': cursor}
+        if following_key is not None:
+            # Continue converting the same page.
+            params['key_name'] = key_name
+            params['following_key'] = following_key
+
+        # Set a task to convert the next batch.
+        from google.appengine.api.labs import taskqueue
+        url = url_for('wiki/migrate-history', area_name=self.area.name)
+        taskqueue.add(url=url, params=params)
+
+        return ''
+
+
+class WikiCompressionMigrationHandler(WikiBaseHandler):
+    """Compresses the text of revisions stored before it was compressed, a
+    batch per task.
+    """
+    def get(self, **kwargs):
+        return self.post(**kwargs)
+
+    def post(self, **kwargs):
+        cursor, count = compress_entities(WikiRevision.all(),
+            self.request.form.get('cursor'))
+        if cursor is None:
+            # All done.
+            return ''
+
+        # Set a task to convert the next batch.
+        from google.appengine.api.labs import taskqueue
+        url = url_for('wiki/migrate-compression', area_name=self.area.name)
+        taskqueue.add(url=url, params={'cursor': cursor})
 
         return ''
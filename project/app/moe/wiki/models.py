@@ -9,20 +9,40 @@
     :license: BSD, see LICENSE.txt for more details.
 """
 import datetime
+import re
 
 from google.appengine.ext import db
 
+import diff_match_patch
+
+from genshi.util import stripentities
+
 from tipfy.ext.wtforms import Form, fields, validators
 
-from tipfy import cached_property
+from tipfy import cached_property, get_config
 from tipfy.ext.db import PickleProperty, get_property_dict, populate_entity
 from tipfy.ext.i18n import lazy_gettext, _
 from tipfy.ext.auth.model import User
 
+from moe.base.pager import Pager
+from moe.base.properties import CompressedTextProperty
+from moe.search.models import add_index_task
+from moe.wiki import WikiPath
+from moe.wiki.cache import (get_cached_tree, get_feed_cache_key,
+    invalidate_page_tree, invalidate_rendered_page, invalidate_rendered_pages,
+    prepend_feed_entry, replace_feed_entry, set_cached_tree)
+
+#: Text properties that history revisions can store as patches.
+DELTA_PROPERTIES = ('body', 'body_raw', 'toc')
+
 
 class WikiRevision(db.Model):
     """Stores content for wiki pages. The latest version is always a root
     entity and past versions have the latest version as ancestor.
+
+    Depending on the ``history_storage`` config, past versions store either a
+    full copy of the text or reverse patches against the next version, with
+    a full copy (a keyframe) every ``history_keyframe_interval`` versions.
     """
     # Creation date.
     created = db.DateTimeProperty()
@@ -37,15 +57,29 @@ class WikiRevision(db.Model):
     # Page title.
     title = db.StringProperty()
     # Body formatted message.
-    body = db.TextProperty()
+    body = CompressedTextProperty()
     # Body raw message, as posted by the user. Only displayed when editing.
-    body_raw = db.TextProperty()
+    body_raw = CompressedTextProperty()
     # Format name: defines a markup processor such as Creole or Markdown.
     format = db.StringProperty(required=True, default='creole')
     # Generated HTML with table of contents: lists all headings in the page.
-    toc = db.TextProperty()
+    toc = CompressedTextProperty()
     # Change notes, set when the node is updated.
     notes = db.StringProperty()
+    # Sequential revision number: the first revision of a page is 1.
+    number = db.IntegerProperty()
+    # Reverse patches against the next revision for the properties listed in
+    # DELTA_PROPERTIES, or None if the text is stored in full.
+    deltas = PickleProperty()
+    # Fingerprint of the parser setup used to render the body.
+    parser_version = db.StringProperty()
+    # Hash, rendered length, headings and links of each section of the body,
+    # used to reparse only the sections that change. Only set in the latest
+    # revision.
+    section_cache = PickleProperty()
+    # Offset, level and slug of the headings that start each section of the
+    # raw body, as returned by moe.wiki.parser.get_section_index().
+    section_index = PickleProperty()
 
     @cached_property
     def id(self):
@@ -72,14 +106,208 @@ class WikiRevision(db.Model):
         else:
             return str(id)
 
+    @property
+    def is_keyframe(self):
+        """Returns ``True`` if this revision must be kept in full when it
+        becomes part of the history.
+        """
+        if self.number is None:
+            return True
+
+        interval = get_config('moe.wiki', 'history_keyframe_interval')
+        return self.number % interval == 0
+
     def populate(self, **kwargs):
         """Sets a batch of property values for this entity."""
         populate_entity(self, **kwargs)
 
+    def get_text_dict(self):
+        """Returns a dictionary with the values of the text properties."""
+        return dict((name, getattr(self, name)) for name in DELTA_PROPERTIES)
+
+    def set_deltas(self, values):
+        """Replaces the text properties by reverse patches against the next
+        revision. The full text is kept if a patch can't rebuild it exactly.
+
+        :param values:
+            A dictionary with the text properties of the next revision, as
+            returned by :meth:`get_text_dict`.
+        :return:
+            ``True`` if the text was replaced by patches, ``False`` otherwise.
+        """
+        deltas = {}
+        for name in DELTA_PROPERTIES:
+            value = getattr(self, name)
+            if value is None:
+                deltas[name] = None
+                continue
+
+            patch = make_patch(values[name], value)
+            try:
+                if apply_patch(values[name], patch) != value:
+                    return False
+            except ValueError:
+                return False
+
+            deltas[name] = patch
+
+        for name in DELTA_PROPERTIES:
+            setattr(self, name, None)
+
+        self.deltas = deltas
+        return True
+
+    def apply_deltas(self, values):
+        """Rebuilds the text properties applying the stored patches to the
+        text of the next revision. After this the revision is a full one.
+        Raises ``ValueError`` if the patches don't apply to that text.
+
+        :param values:
+            A dictionary with the text properties of the next revision, as
+            returned by :meth:`get_text_dict`.
+        :return:
+            ``None``.
+        """
+        for name in DELTA_PROPERTIES:
+            patch = self.deltas.get(name)
+            if patch is not None:
+                setattr(self, name, db.Text(apply_patch(values[name], patch)))
+            else:
+                setattr(self, name, None)
+
+        self.deltas = None
+
+    @classmethod
+    def restore_history(cls, revisions):
+        """Rebuilds the text of revisions stored as patches.
+
+        Revisions are restored newest first. When the next revision is also
+        in the list it is used directly; otherwise the revisions up to the
+        next full one are loaded with a single query.
+
+        :param revisions:
+            A list of :class:`WikiRevision` entities.
+        :return:
+            The same list of revisions, all with text properties set.
+        """
+        pending = [r for r in revisions if r.deltas is not None]
+        if not pending:
+            return revisions
+
+        numbers = dict(((r.parent_key() or r.key(), r.number), r)
+            for r in revisions)
+
+        pending.sort(key=lambda r: r.number, reverse=True)
+        for revision in pending:
+            following = numbers.get((revision.parent_key(),
+                revision.number + 1))
+            if following is None or following.deltas is not None:
+                following = cls._restore_following(revision)
+
+            revision.apply_deltas(following.get_text_dict())
+
+        return revisions
+
+    @classmethod
+    def _restore_following(cls, revision):
+        """Loads and restores the revision that follows a given one."""
+        interval = get_config('moe.wiki', 'history_keyframe_interval')
+        query = cls.all().ancestor(revision.parent_key()) \
+                         .filter('number >', revision.number) \
+                         .order('number')
+
+        chain = []
+        while True:
+            entities = query.fetch(interval)
+            chain.extend(entities)
+            if len(entities) < interval or \
+                [e for e in entities if e.deltas is None]:
+                break
+
+            query.with_cursor(query.cursor())
+
+        for index, entity in enumerate(chain):
+            if entity.deltas is None:
+                break
+        else:
+            raise db.Error('Revision history for %s is broken.' %
+                revision.parent_key().name())
+
+        for i in xrange(index - 1, -1, -1):
+            chain[i].apply_deltas(chain[i + 1].get_text_dict())
+
+        return chain[0]
+
+    @classmethod
+    def migrate_history(cls, key_name, following_key=None, limit=20):
+        """Converts a batch of past revisions of a page to the configured
+        history storage, newest first. Revisions are renumbered and stored as
+        keyframes or patches as if they were saved with the current config.
+        Each batch runs in a transaction on the entity group of the page, so
+        that revisions saved meanwhile are not numbered twice.
+
+        :param key_name:
+            Key name of the latest revision of the page.
+        :param following_key:
+            Key of the last revision converted by the previous batch, or
+            ``None`` to start from the latest revision.
+        :param limit:
+            Maximum number of revisions to convert.
+        :return:
+            The key of the last converted revision to pass to the next batch,
+            or ``None`` if the whole history was converted.
+        """
+        use_deltas = get_config('moe.wiki', 'history_storage') == 'delta'
+
+        def txn():
+            if following_key is None:
+                following = cls.get_by_key_name(key_name)
+                if following is None:
+                    return None
+
+                following.number = cls.all(keys_only=True) \
+                                      .ancestor(following).count()
+                following.put()
+            else:
+                following = cls.get(following_key)
+                if following is None:
+                    return None
+
+                following = cls.restore_history([following])[0]
+
+            root_key = following.parent_key() or following.key()
+            revisions = cls.all().ancestor(root_key) \
+                                 .filter('updated <', following.updated) \
+                                 .order('-updated') \
+                                 .fetch(limit)
+
+            number = following.number
+            values = following.get_text_dict()
+            for revision in revisions:
+                number -= 1
+                revision.number = number
+                if revision.deltas is not None:
+                    revision.apply_deltas(values)
+
+                next_values = revision.get_text_dict()
+                if use_deltas and not revision.is_keyframe:
+                    revision.set_deltas(values)
+
+                values = next_values
+
+            if revisions:
+                db.put(revisions)
+
+            if len(revisions) == limit:
+                return str(revisions[-1].key())
+
+        return db.run_in_transaction(txn)
+
     @classmethod
     def update(cls, area, path, **kwargs):
         """Creates or updates a revision transactionally. By default, stores
-        the existing entity as a new entity with the current entity as parent.
+        the existing entity as a new entity with the current entity as parent,
+        as a full copy or as patches depending on the history storage.
         """
         key_name = cls.get_key_name(area, path)
         entities = []
@@ -88,23 +316,81 @@ class WikiRevision(db.Model):
         kwargs['created'] = now
         kwargs['updated'] = now
 
+        use_deltas = get_config('moe.wiki', 'history_storage') == 'delta'
+
         def txn():
             entity = cls.get_by_key_name(key_name)
 
             if entity:
                 # Create a new entity for the revision history.
                 old = cls(parent=entity, **get_property_dict(entity))
+                old.section_cache = None
+                if old.number is None:
+                    # Saved before revisions were numbered: the latest
+                    # revision is the last one of the history.
+                    old.number = cls.all(keys_only=True) \
+                                    .ancestor(entity).count()
+
                 # Populate old entity with new values.
                 entity.populate(**kwargs)
+                entity.number = (old.number or 0) + 1
+                if use_deltas and not old.is_keyframe:
+                    # Store only what is needed to rebuild the old text.
+                    old.set_deltas(entity.get_text_dict())
+
                 # Save both entities.
                 db.put([entity, old])
             else:
                 # This is a new page, so author and editor are the same.
                 kwargs.setdefault('author_key', kwargs.get('editor_key'))
-                entity = cls(key_name=key_name, **kwargs)
+                entity = cls(key_name=key_name, number=1, **kwargs)
                 entity.put()
+                old = None
+
+            return entity, old
 
-            return entity
+        entity, old = db.run_in_transaction(txn)
+        # Cached renders of the page are now outdated.
+        invalidate_rendered_page(key_name)
+        update_feeds(area, path, entity, old)
+        add_index_task(area, 'wiki', path)
+        return entity
+
+    @classmethod
+    def save_rewritten(cls, revision, old_values):
+        """Saves the latest revision of a page after its text was rewritten
+        in place, e.g. when it is reparsed. The patches of the previous
+        revision are rebuilt against the new text in the same transaction,
+        so that the history can still be restored.
+
+        :param revision:
+            The latest :class:`WikiRevision` of a page, with the new text
+            set.
+        :param old_values:
+            A dictionary with the text properties before they were rewritten,
+            as returned by :meth:`get_text_dict`.
+        :return:
+            ``True`` if the revision was saved, ``False`` if the page was
+            updated meanwhile.
+        """
+        def txn():
+            latest = cls.get(revision.key())
+            if latest is None or latest.updated != revision.updated:
+                return False
+
+            to_put = [revision]
+            if revision.number:
+                previous = cls.all().ancestor(revision) \
+                                    .filter('number =', revision.number - 1) \
+                                    .get()
+                if previous is not None and previous.deltas is not None:
+                    previous.apply_deltas(old_values)
+                    # Kept in full if it can't be patched exactly.
+                    previous.set_deltas(revision.get_text_dict())
+                    to_put.append(previous)
+
+            db.put(to_put)
+            return True
 
         return db.run_in_transaction(txn)
 
@@ -123,7 +409,11 @@ class WikiRevision(db.Model):
 
     @classmethod
     def get_revision(cls, area, path, version=None):
-        return cls.get(cls.get_key(area, path, version))
+        revision = cls.get(cls.get_key(area, path, version))
+        if revision is not None:
+            cls.restore_history([revision])
+
+        return revision
 
     @classmethod
     def get_latest_revisions(cls, area, path, limit=2):
@@ -132,14 +422,15 @@ class WikiRevision(db.Model):
                        .order('-updated') \
                        .fetch(limit)
 
-        return res or []
+        return cls.restore_history(res or [])
 
 
 class WikiPage(db.Model):
     # Creation date.
     created = db.DateTimeProperty(auto_now_add=True)
-    # Modification date.
-    updated = db.DateTimeProperty(auto_now=True)
+    # Modification date. Set only when the page content changes, so that
+    # updating counters or links doesn't affect the list of changes.
+    updated = db.DateTimeProperty(auto_now_add=True)
     # Key to the area where this page is published.
     area_key = db.StringProperty()
     # The URL path to the page.
@@ -148,20 +439,107 @@ class WikiPage(db.Model):
     parent_path = db.StringProperty()
     # Paths to all parents of this page.
     parent_paths = db.StringListProperty()
+    # Number of direct children pages.
+    child_count = db.IntegerProperty(default=0)
+    # Number of pages below this one, at any depth.
+    descendant_count = db.IntegerProperty(default=0)
     # Tags.
     tags = db.StringListProperty()
     # Dependencies.
     deps = PickleProperty()
+    # Paths of the pages linked from the latest revision.
+    links = db.StringListProperty()
 
     @classmethod
     def update(cls, area, path, **kwargs):
-        """Creates or updates a page."""
+        """Creates or updates a page. When a page is created, the child counts
+        of the pages above it are updated.
+        """
         kwargs['area_key'] = str(area.key())
         kwargs['path'] = path
-        page = cls(key_name=cls.get_key_name(area, path), **kwargs)
-        page.put()
+        kwargs.setdefault('updated', datetime.datetime.now())
+        key_name = cls.get_key_name(area, path)
+
+        def txn():
+            page = cls.get_by_key_name(key_name)
+            if page is None:
+                page = cls(key_name=key_name, **kwargs)
+                created = True
+            else:
+                page.populate(**kwargs)
+                created = False
+
+            page.put()
+            return page, created
+
+        page, created = db.run_in_transaction(txn)
+
+        if created:
+            # Children may have been created before this page.
+            query = cls.all(keys_only=True).filter('area_key', kwargs['area_key'])
+            page.child_count = query.filter('parent_path', path).count()
+            if page.child_count:
+                page.descendant_count = cls.count_descendants(area, path)
+                page.put()
+
+            page.update_parent_counts(area)
+            invalidate_page_tree(kwargs['area_key'])
+            invalidate_backlinks(area, path)
+
         return page
 
+    @classmethod
+    def count_descendants(cls, area, path):
+        """Counts all pages below a given path with a single query.
+
+        :param area:
+            The area of the pages.
+        :param path:
+            Page path.
+        :return:
+            The number of pages below the path, at any depth.
+        """
+        return cls.all(keys_only=True).filter('area_key', str(area.key())) \
+                                      .filter('parent_paths', path) \
+                                      .count()
+
+    @classmethod
+    def get_missing_links(cls, area, paths):
+        """Returns the paths that don't have a page, with a single get.
+
+        :param area:
+            The area of the pages.
+        :param paths:
+            A list of page paths.
+        :return:
+            A list with the paths from ``paths`` that don't exist.
+        """
+        keys = [db.Key.from_path(cls.kind(), cls.get_key_name(area, path))
+            for path in paths]
+        return [path for path, page in zip(paths, db.get(keys))
+            if page is None]
+
+    def update_parent_counts(self, area):
+        """Counts this page, after it is created, in the children and
+        descendants of all pages above it. Pages that don't exist are
+        skipped: their counts are set when they are created.
+
+        Pages above are separate entity groups, so each one is incremented
+        in its own transaction.
+        """
+        def txn(key_name, is_parent):
+            page = WikiPage.get_by_key_name(key_name)
+            if page is not None:
+                if is_parent:
+                    page.child_count = (page.child_count or 0) + 1
+
+                page.descendant_count = (page.descendant_count or 0) + 1
+                page.put()
+
+        for path in self.parent_paths:
+            db.run_in_transaction(txn, WikiPage.get_key_name(area, path),
+                path == self.parent_path)
+
     @classmethod
     def get_key_name(cls, area, path):
         return '%s:%s' % (str(area.key()), path)
@@ -215,72 +593,325 @@ class WikiRevisionForm(Form):
     note = fields.TextField(lazy_gettext('Change note'))
 
 
-def wiki_revisions_pager(revision, cursor=None, limit=20):
-    def get_query(keys_only=False, cursor=None):
-        return WikiRevision.all(keys_only=keys_only, cursor=cursor) \
-                           .ancestor(revision) \
-                           .order('-updated')
+def get_feed_entry(revision, path, version=None):
+    """Returns the values used to build a feed entry for a revision.
 
-    query = get_query(cursor=cursor)
-    entities = query.fetch(limit)
-    query_cursor = None
+    :param revision:
+        A :class:`WikiRevision` entity, with its text restored.
+    :param path:
+        Page path.
+    :param version:
+        Version to link to, or ``None`` to link to the latest one.
+    :return:
+        A dictionary with the entry values. Depending on the
+        ``feed_summary_length`` config, it has either the full page body as
+        ``content`` or a plain text ``summary``.
+    """
+    entry = {
+        'title':     revision.title,
+        'author':    revision.editor.username,
+        'path':      path,
+        'version':   version,
+        'updated':   revision.updated,
+        'published': revision.created,
+        'content':   None,
+        'summary':   None,
+    }
+
+    length = get_config('moe.wiki', 'feed_summary_length')
+    if length:
+        entry['summary'] = get_summary(revision.body, length)
+    else:
+        entry['content'] = unicode(revision.body)
 
-    if entities:
-        query_cursor = query.cursor()
+    return entry
 
-        # Check if we have "next" results.
-        res = get_query(keys_only=True, cursor=query_cursor).get()
-        if res is None:
-            query_cursor = None
 
-    return entities, query_cursor
+def get_summary(html, length):
+    """Returns a plain text summary of an HTML text, truncated at a word
+    boundary to up to ``length`` characters. HTML entities are unescaped.
+    """
+    text = re.sub(r'\s+', u' ', re.sub(r'<[^>]*>', u' ', html or u'')).strip()
+    text = stripentities(text)
+    if len(text) <= length:
+        return text
+
+    return text[:length].rsplit(u' ', 1)[0] + u'...'
+
+
+def update_feeds(area, path, revision, old=None):
+    """Updates cached feeds after a page is saved.
+
+    :param area:
+        The area of the page.
+    :param path:
+        Page path.
+    :param revision:
+        The new latest revision of the page.
+    :param old:
+        The previous latest revision, now in the page history, or ``None``
+        if the page was created.
+    :return:
+        ``None``.
+    """
+    entry = get_feed_entry(revision, path)
+    area_key = str(area.key())
 
+    # Latest changes: the page moves to the top.
+    def remove_page(e):
+        if e['path'] != path:
+            return e
 
-def wiki_changes_pager(area, cursor=None, limit=20):
-    def get_query(keys_only=False, cursor=None):
-        return WikiPage.all(keys_only=keys_only, cursor=cursor) \
-                       .filter('area_key', str(area.key())) \
-                       .order('-updated')
+    prepend_feed_entry(get_feed_cache_key('changes', area_key), entry,
+        remove_page)
 
-    query = get_query(cursor=cursor)
-    entities = query.fetch(limit)
+    if old is not None:
+        # Page history: the entry for the previous revision now links to its
+        # version number.
+        def set_version(e):
+            if e['version'] is None:
+                e = dict(e, version=str(old.key().id()))
 
-    if not entities:
-        query_cursor = None
-    else:
-        query_cursor = query.cursor()
+            return e
+
+        prepend_feed_entry(get_feed_cache_key('page-changes',
+            revision.key().name()), entry, set_version)
+
+    # Page list: updated in place, or reloaded if the page is new.
+    parent_path = WikiPath(path).parent_path
+    replace_feed_entry(get_feed_cache_key('list', area_key, parent_path),
+        entry, lambda e: e['path'] == path)
+
+
+def make_patch(text1, text2):
+    """Returns a textual patch to turn ``text1`` into ``text2``."""
+    dmp = diff_match_patch.diff_match_patch()
+    return dmp.patch_toText(dmp.patch_make(text1 or u'', text2))
+
+
+def apply_patch(text, patch):
+    """Applies a patch created by :func:`make_patch` to ``text``. Raises
+    ``ValueError`` if any of its hunks can't be applied.
+    """
+    dmp = diff_match_patch.diff_match_patch()
+    result, applied = dmp.patch_apply(dmp.patch_fromText(patch), text or u'')
+    if False in applied:
+        raise ValueError('Patch failed: %d of %d hunks not applied.' %
+            (applied.count(False), len(applied)))
+
+    return result
+
+
+def prefetch_users(revisions):
+    """Loads authors and editors for a list of revisions with a single batch
+    get, so that accessing ``author`` or ``editor`` won't fetch them again.
+
+    :param revisions:
+        A list of :class:`WikiRevision` entities.
+    :return:
+        The same list of revisions.
+    """
+    keys = set()
+    for revision in revisions:
+        keys.update(k for k in (revision.author_key, revision.editor_key) if k)
 
-        # Check if we have "next" results.
-        res = get_query(keys_only=True, cursor=query_cursor).get()
-        if res is None:
-            query_cursor = None
+    if not keys:
+        return revisions
 
-    return entities, query_cursor
+    keys = list(keys)
+    users = dict(zip(keys, db.get([db.Key(key) for key in keys])))
+    for revision in revisions:
+        # Set the values stored by the cached properties.
+        revision.__dict__['author'] = users.get(revision.author_key)
+        revision.__dict__['editor'] = users.get(revision.editor_key)
 
+    return revisions
 
-def wiki_list_pager(area, parent_path=None, cursor=None, limit=20):
-    def get_query(keys_only=False, cursor=None):
-        query = WikiPage.all(keys_only=keys_only) \
-                        .filter('area_key', str(area.key())) \
-                        .filter('parent_path', parent_path) \
-                        .order('path')
 
-        if cursor is not None:
-            query.with_cursor(cursor)
+def get_page_revisions(pages):
+    """Loads the latest revision of a list of pages with a single batch get.
+    Authors and editors of the revisions are also loaded.
 
-        return query
+    :param pages:
+        A list of :class:`WikiPage` entities.
+    :return:
+        A list of ``(page, revision)`` tuples. Pages without a latest
+        revision are left out.
+    """
+    revisions = db.get([page.latest_revision_key for page in pages])
+    prefetch_users([revision for revision in revisions if revision])
+    for page, revision in zip(pages, revisions):
+        # Set the value stored by the cached property.
+        page.__dict__['latest_revision'] = revision
+
+    return [(page, revision) for page, revision in zip(pages, revisions)
+        if revision is not None]
+
+
+def get_page_tree(area):
+    """Returns a tree with all pages in an area, for navigation. The tree is
+    built from a keys only query and cached until a page is created.
+
+    :param area:
+        An :class:`Area` entity.
+    :return:
+        A list of nodes for the top level pages, sorted by path. Each node is
+        a dictionary with ``path``, ``name``, ``exists`` (``False`` for
+        paths that only have children pages) and a list of ``children``
+        nodes.
+    """
+    area_key = str(area.key())
+    tree = get_cached_tree(area_key)
+    if tree is not None:
+        return tree
+
+    query = WikiPage.all(keys_only=True).filter('area_key', area_key)
+    paths = []
+    while True:
+        keys = query.fetch(1000)
+        paths.extend(key.name().split(':', 1)[1] for key in keys)
+        if len(keys) < 1000:
+            break
+
+        query.with_cursor(query.cursor())
+
+    nodes = {}
+    tree = []
+
+    def get_node(path, exists):
+        node = nodes.get(path)
+        if node is None:
+            wiki_path = WikiPath(path)
+            node = nodes[path] = {
+                'path':     path,
+                'name':     wiki_path.page_name,
+                'exists':   exists,
+                'children': [],
+            }
+            if wiki_path.parent_path:
+                get_node(wiki_path.parent_path, False)['children'].append(
+                    node)
+            else:
+                tree.append(node)
+        elif exists:
+            node['exists'] = True
+
+        return node
+
+    for path in sorted(paths):
+        get_node(path, True)
+
+    set_cached_tree(area_key, tree)
+    return tree
+
+
+def invalidate_backlinks(area, path):
+    """Invalidates the cached renders of all pages linking to a page. Called
+    when the page is created or deleted, so that links to it are rendered
+    again.
+
+    :param area:
+        The area of the page.
+    :param path:
+        Page path.
+    :return:
+        ``None``.
+    """
+    query = WikiPage.all(keys_only=True).filter('area_key', str(area.key())) \
+                                        .filter('links', path)
+    while True:
+        keys = query.fetch(500)
+        invalidate_rendered_pages([key.name() for key in keys])
+        if len(keys) < 500:
+            break
+
+        query.with_cursor(query.cursor())
+
+
+def wiki_revisions_pager(revision, cursor=None, limit=20):
+    query = WikiRevision.all().ancestor(revision).order('-updated')
+
+    def match(entity):
+        key = entity.key()
+        while key is not None and key != revision.key():
+            key = key.parent()
+
+        return key is not None
 
-    query = get_query(cursor=cursor)
-    entities = query.fetch(limit)
+    pager = Pager(query, limit=limit, prefetch=prefetch_users, match=match)
+    pager.fetch(cursor)
+    return pager
 
-    if not entities:
-        query_cursor = None
+
+def wiki_changes_pager(area, cursor=None, limit=20, with_revisions=False):
+    """Returns a :class:`moe.base.pager.Pager` with the latest changed pages
+    in an area. If ``with_revisions`` is ``True``, results are
+    ``(page, revision)`` tuples with the latest revision of each page.
+    """
+    area_key = str(area.key())
+    query = WikiPage.all().filter('area_key', area_key) \
+                          .order('-updated')
+
+    if with_revisions:
+        prefetch = get_page_revisions
     else:
-        query_cursor = query.cursor()
+        prefetch = None
+
+    pager = Pager(query, limit=limit, prefetch=prefetch,
+        match=lambda page: page.area_key == area_key)
+    pager.fetch(cursor)
+    return pager
 
-        # Check if we have "next" results.
-        res = get_query(keys_only=True, cursor=query_cursor).get()
-        if res is None:
-            query_cursor = None
 
-    return entities, query_cursor
+def wiki_list_pager(area, parent_path=None, cursor=None, limit=20,
+    with_revisions=False):
+    """Returns a :class:`moe.base.pager.Pager` with the child pages of a
+    given path. If ``with_revisions`` is ``True``, results are
+    ``(page, revision)`` tuples with the latest revision of each page.
+    """
+    area_key = str(area.key())
+    query = WikiPage.all().filter('area_key', area_key) \
+                          .filter('parent_path', parent_path) \
+                          .order('path')
+
+    if with_revisions:
+        prefetch = get_page_revisions
+    else:
+        prefetch = None
+
+    pager = Pager(query, limit=limit, prefetch=prefetch,
+        match=lambda page: page.area_key == area_key and
+            page.parent_path == parent_path)
+    pager.fetch(cursor)
+    return pager
+
+
+def wiki_subtree_pager(area, path, cursor=None, limit=20):
+    """Returns a :class:`moe.base.pager.Pager` with all pages below a given
+    path, at any depth, sorted by path.
+    """
+    area_key = str(area.key())
+    query = WikiPage.all().filter('area_key', area_key) \
+                          .filter('parent_paths', path) \
+                          .order('path')
+
+    pager = Pager(query, limit=limit,
+        match=lambda page: page.area_key == area_key and
+            path in page.parent_paths)
+    pager.fetch(cursor)
+    return pager
+
+
+def wiki_backlinks_pager(area, path, cursor=None, limit=20):
+    """Returns a :class:`moe.base.pager.Pager` with all pages linking to a
+    given path, sorted by path.
+    """
+    area_key = str(area.key())
+    query = WikiPage.all().filter('area_key', area_key) \
+                          .filter('links', path) \
+                          .order('path')
+
+    pager = Pager(query, limit=limit,
+        match=lambda page: page.area_key == area_key and path in page.links)
+    pager.fetch(cursor)
+    return pager
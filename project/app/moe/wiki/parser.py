@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import re
+import threading
 
 import creoleparser
 import creoleparser.elements
@@ -8,20 +10,21 @@ import genshi
 import genshi.core
 
 import pygments
-import pygments.lexers
-import pygments.formatters
 
 from werkzeug import url_quote
 
-from tipfy import local, escape, url_for
+from tipfy import escape, url_for
 from tipfy.ext.i18n import _
 from tipfy.ext.db import _slugify
 
+from moe.base.highlighting import highlight_code
 from moe.wiki import WikiPath
 
 
-formatter = pygments.formatters.HtmlFormatter()
-default_lexer = pygments.lexers.get_lexer_by_name('text')
+#: Version of the parser setup in this module. Increment it when changing
+#: anything that affects the output and is not covered by
+#: :func:`get_parser_fingerprint`.
+PARSER_VERSION = 2
 
 
 class Heading(creoleparser.elements.Heading):
@@ -31,16 +34,10 @@ class Heading(creoleparser.elements.Heading):
 
         slug = _slugify(heading_text, default='heading')
         if environ is not None:
+            environ.setdefault('base_slugs', []).append(slug)
             headings = environ.setdefault('headings', [])
-            i = 1
-            original_slug = slug
-            while True:
-                if slug not in headings:
-                    headings.append(slug)
-                    break
-
-                slug = '%s_%d' % (original_slug, i)
-                i += 1
+            slug = get_unique_slug(slug, headings)
+            headings.append(slug)
 
             toc = environ.setdefault('toc', [])
             toc.append((heading_tag, escape(heading_text), slug))
@@ -58,6 +55,30 @@ class Heading(creoleparser.elements.Heading):
         return heading([text, anchor, anchor_link], class_='heading')
 
 
+def get_unique_slug(slug, headings):
+    """Returns a slug that is not in the list of slugs already used in a
+    page, adding a numeric suffix if needed.
+    """
+    i = 1
+    original_slug = slug
+    while slug in headings:
+        slug = '%s_%d' % (original_slug, i)
+        i += 1
+
+    return slug
+
+
+def get_unique_slugs(slugs, headings):
+    """Returns the unique slugs for a list of headings added after the
+    headings already used in a page.
+    """
+    used = list(headings)
+    for slug in slugs:
+        used.append(get_unique_slug(slug, used))
+
+    return used[len(headings):]
+
+
 def parse_macro(name, arg_string, body, isblock, environ):
     macro = MACROS.get(name, None)
     if not macro:
@@ -92,16 +113,10 @@ def macro_code(name, arg_string, body, isblock, environ, *args, **kwargs):
                 lines.append(line)
 
             body = u'\n'.join(lines)
-
-        try:
-            lexer = pygments.lexers.get_lexer_by_name(language)
-        except pygments.lexers.ClassNotFound:
-            lexer = default_lexer
     else:
-        lexer = default_lexer
+        language = 'text'
 
-    return genshi.core.Markup(pygments.highlight(body, lexer,
-        formatter))
+    return genshi.core.Markup(highlight_code(body, language))
 
 
 def macro_note(name, arg_string, body, isblock, environ, *args, **kwargs):
@@ -115,30 +130,109 @@ def macro_note(name, arg_string, body, isblock, environ, *args, **kwargs):
         I am a warning!
         <</warning>>
     """
-    body = wiki_parser.parse(body)
+    if environ is not None and 'parser' in environ:
+        # Parse the note with the parser being used for the page. Headings
+        # in the note are not added to the table of contents, and their
+        # slugs are only unique in the note, so that they don't change the
+        # anchors of the page headings that follow.
+        note_environ = {
+            'parser':   environ['parser'],
+            'links':    environ.get('links'),
+            'headings': [],
+        }
+        body = environ['parser'].render(body, note_environ)
+    else:
+        body = escape(body or u'')
+
     return genshi.Markup("""<div class="macro-note %s">
         <p class="title">%s:</p>
         %s
     </div>""" % (name, name.capitalize(), body))
 
 
-def create_wiki_link(path):
-    """Creates a wiki link given a path."""
-    anchor = None
-    parts = path.split('#', 1)
-    if len(parts) > 1:
-        path = parts[0]
-        anchor = parts[1]
+class WikiParser(object):
+    """A creole parser with its own dialect instance. Wiki links are created
+    by a function set for each call, so a parser must be used by one thread
+    at a time: use :data:`parser_pool` to get one.
+    """
+    def __init__(self):
+        self.link_func = None
+        options = dict(DIALECT_OPTIONS, wiki_links_path_func=self.create_link)
+        dialect = creoleparser.create_dialect(
+            creoleparser.dialects.creole11_base, **options)
+        dialect.headings = Heading(HEADING_TAGS, '=')
+        self.parser = creoleparser.Parser(dialect=dialect, encoding=None)
+
+    def create_link(self, path):
+        return self.link_func(path)
+
+    def parse(self, body_raw, environ, link_func):
+        """Renders wiki markup.
+
+        :param body_raw:
+            The text to be parsed.
+        :param environ:
+            A dictionary passed to macros and headings.
+        :param link_func:
+            A function that receives a wiki link path and returns the URL.
+        :return:
+            The rendered HTML.
+        """
+        self.link_func = link_func
+        environ['parser'] = self
+        try:
+            return self.render(body_raw, environ)
+        finally:
+            self.link_func = None
+            del environ['parser']
 
-    page_path = WikiPath(path).normalized_path
-    url = url_for('wiki/index', page_path=page_path, area_name=local.area.name)
-    if anchor:
-        url += '#' + url_quote(anchor)
+    def render(self, body_raw, environ):
+        """Renders wiki markup using the current link function. Used by
+        macros to parse their contents.
+        """
+        return self.parser(body_raw, environ=environ)
 
-    return url
 
+class ParserPool(object):
+    """Keeps prebuilt parsers to be used by one thread at a time. Building a
+    parser is expensive, so parsers are returned to the pool after use.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self._lock = threading.Lock()
+        self._parsers = []
+
+    def acquire(self):
+        """Returns a parser from the pool, or a new one if all are in use."""
+        self._lock.acquire()
+        try:
+            if self._parsers:
+                return self._parsers.pop()
+        finally:
+            self._lock.release()
+
+        return WikiParser()
+
+    def release(self, parser):
+        """Returns a parser to the pool."""
+        self._lock.acquire()
+        try:
+            if len(self._parsers) < self.size:
+                self._parsers.append(parser)
+        finally:
+            self._lock.release()
 
-def get_wiki_link_func(area):
+
+def get_wiki_link_func(area, links=None):
+    """Returns a function to create wiki links for a given area.
+
+    :param area:
+        The area of the linked pages.
+    :param links:
+        Optional list where the paths of the linked pages are appended.
+    :return:
+        A function that receives a link path and returns the link URL.
+    """
     def create_wiki_link(path):
         """Creates a wiki link given a path."""
         anchor = None
@@ -148,6 +242,9 @@ def get_wiki_link_func(area):
             anchor = parts[1]
 
         page_path = WikiPath(path).normalized_path
+        if links is not None and page_path not in links:
+            links.append(page_path)
+
         url = url_for('wiki/index', page_path=page_path, area_name=area.name)
         if anchor:
             url += '#' + url_quote(anchor)
@@ -157,22 +254,154 @@ def get_wiki_link_func(area):
     return create_wiki_link
 
 
-def get_page_sections(body, index=None):
-    """Returns a section of the page."""
-    sections = []
-    section = ''
-    for line in body.splitlines():
-        res = heading_re.match(line)
-        if res:
-            #if index is not None and len(sections) == index:
-            #    return section.strip()
-            sections.append(section.strip())
-            section = line + '\n'
+def get_section_index(body_raw, title=None):
+    """Finds the headings that start page sections, in a single pass.
+    Headings inside preformatted blocks and block macros don't start
+    sections. A macro line only opens a block if a closing tag for the macro
+    follows it. Slugs are numbered as :class:`Heading` does when the page is
+    parsed, so they match the anchors in the rendered page. Headings in notes
+    have their own slugs, so they are skipped.
+
+    :param body_raw:
+        The page body, in wiki markup.
+    :param title:
+        The page title, which is the first heading of the page.
+    :return:
+        A list with a tuple ``(offset, level, slug)`` for each heading that
+        starts a section, where ``offset`` is the position of the heading
+        line in ``body_raw``.
+    """
+    used = []
+    if title is not None:
+        used.append(_slugify(title, default=u'heading'))
+
+    # Position of the last closing tag of each block macro.
+    closing = dict((res.group(1), res.start()) for res in
+        block_macro_end_re.finditer(body_raw))
+
+    index = []
+    offset = 0
+    block = None
+    depth = 0
+    for line in body_raw.splitlines(True):
+        stripped = line.strip()
+        if block == '{{{':
+            if stripped == '}}}':
+                block = None
+        elif block is not None:
+            if stripped.startswith('<<%s' % block):
+                depth += 1
+            elif stripped.startswith('<</%s>>' % block):
+                depth -= 1
+                if not depth:
+                    block = None
+        elif stripped == '{{{':
+            block = '{{{'
         else:
-            section += line + '\n'
+            res = block_macro_re.match(stripped)
+            if res and '<</%s>>' % res.group(1) not in stripped and \
+                closing.get(res.group(1), -1) >= offset + len(line):
+                block = res.group(1)
+                depth = 1
+            else:
+                res = heading_re.match(line)
+                if res:
+                    slug = get_unique_slug(_slugify(res.group(2),
+                        default='heading'), used)
+                    used.append(slug)
+                    index.append((offset, len(res.group(1)), slug))
+
+        offset += len(line)
+
+    return index
+
+
+def get_section_bounds(body_raw, section, index):
+    """Returns the start and end positions of a page section.
+
+    :param body_raw:
+        The page body, in wiki markup.
+    :param section:
+        Section number. Section 0 is the text before the first heading.
+    :param index:
+        The section index returned by :func:`get_section_index`.
+    :return:
+        A tuple ``(start, end)``.
+    :raises:
+        ``IndexError`` if the section doesn't exist.
+    """
+    if section < 0 or section > len(index):
+        raise IndexError(section)
 
-    sections.append(section.strip())
-    return sections
+    offsets = [0] + [entry[0] for entry in index] + [len(body_raw)]
+    return offsets[section], offsets[section + 1]
+
+
+def get_page_sections(body_raw, index=None):
+    """Returns the sections of a page.
+
+    :param body_raw:
+        The page body, in wiki markup.
+    :param index:
+        The section index returned by :func:`get_section_index`, or
+        ``None`` to build it.
+    :return:
+        A list with the text of each section. The first one is the text
+        before the first heading.
+    """
+    if index is None:
+        index = get_section_index(body_raw)
+
+    offsets = [0] + [entry[0] for entry in index] + [len(body_raw)]
+    return [body_raw[start:end].strip() for start, end in zip(offsets,
+        offsets[1:])]
+
+
+def get_page_section(body_raw, section, index=None):
+    """Returns the text of a page section.
+
+    :param body_raw:
+        The page body, in wiki markup.
+    :param section:
+        Section number. Section 0 is the text before the first heading.
+    :param index:
+        The section index returned by :func:`get_section_index`, or
+        ``None`` to build it.
+    :return:
+        The section text.
+    :raises:
+        ``IndexError`` if the section doesn't exist.
+    """
+    if index is None:
+        index = get_section_index(body_raw)
+
+    start, end = get_section_bounds(body_raw, section, index)
+    return body_raw[start:end].strip()
+
+
+def replace_page_section(body_raw, section, text, index=None):
+    """Replaces the text of a page section.
+
+    :param body_raw:
+        The page body, in wiki markup.
+    :param section:
+        Section number. Section 0 is the text before the first heading.
+    :param text:
+        The new section text.
+    :param index:
+        The section index returned by :func:`get_section_index`, or
+        ``None`` to build it.
+    :return:
+        The new page body.
+    :raises:
+        ``IndexError`` if the section doesn't exist.
+    """
+    if index is None:
+        index = get_section_index(body_raw)
+
+    start, end = get_section_bounds(body_raw, section, index)
+    parts = [body_raw[:start].strip(), text.strip(), body_raw[end:].strip()]
+    return u'\n\n'.join([part for part in parts if part])
 
 
 def heading_re_string():
@@ -199,25 +428,170 @@ def get_toc(data):
     return res + u'</ul>'
 
 
-def parse_page(body_raw, environ, area):
-    # Factory link creation function to use current area.
-    wiki_parser.dialect.link.path_func = get_wiki_link_func(area)
+def mark_missing_links(html, area, paths):
+    """Adds the class ``missing`` to links pointing to pages that don't
+    exist.
+
+    :param html:
+        A rendered page body.
+    :param area:
+        The area of the linked pages.
+    :param paths:
+        Paths of the linked pages that don't exist.
+    :return:
+        The page body with the links marked.
+    """
+    for path in paths:
+        url = url_for('wiki/index', page_path=path, area_name=area.name)
+        for href in ('href="%s"' % url, 'href="%s#' % url):
+            html = html.replace(href, 'class="missing" ' + href)
+
+    return html
+
+
+def get_page_environ(title):
+    """Returns the initial parsing environment for a page. The title is the
+    first heading of the page.
+    """
+    slug = _slugify(title, default=u'heading')
+    return {
+        'headings': [slug],
+        'toc':      [('h1', escape(title), slug)],
+    }
+
+
+def get_parser_fingerprint():
+    """Returns a hash that identifies the parser setup: the versions of
+    creoleparser, Pygments and this module, the available macros and the
+    dialect options. Revisions parsed with a different fingerprint are
+    outdated and must be parsed again.
+    """
+    global _fingerprint
+    if _fingerprint is None:
+        parts = [
+            PARSER_VERSION,
+            getattr(creoleparser, '__version__', None),
+            pygments.__version__,
+            sorted((name, macro.__name__) for name, macro in MACROS.items()),
+            sorted(DIALECT_OPTIONS),
+            HEADING_TAGS,
+        ]
+        _fingerprint = hashlib.md5(repr(parts)).hexdigest()
+
+    return _fingerprint
+
+
+def parse_page(body_raw, environ, area, link_func=None):
+    """Parses a page body. It is safe to call it from several threads.
+
+    :param body_raw:
+        The page body, in wiki markup.
+    :param environ:
+        A dictionary with the parsing environment, as returned by
+        :func:`get_page_environ`. The paths of linked pages are stored as a
+        list in ``environ['links']``.
+    :param area:
+        The area of the page.
+    :param link_func:
+        Optional function to create wiki links. By default links point to
+        pages in the same area.
+    :return:
+        A tuple ``(body, toc)`` with the rendered body and table of contents.
+    """
+    if link_func is None:
+        link_func = get_wiki_link_func(area, environ.setdefault('links', []))
+
+    parser = parser_pool.acquire()
+    try:
+        body = parser.parse(body_raw, environ, link_func)
+    finally:
+        parser_pool.release(parser)
 
-    # Parse wiki markup.
-    body = wiki_parser(body_raw, environ=environ)
     toc = get_toc(environ.get('toc'))
     return (body, toc)
 
 
+def parse_page_sections(sections, environ, area, cache=None, cached_body=None):
+    """Parses a page split in sections, reusing the rendered HTML of the
+    sections that didn't change since the page was parsed before.
+
+    Sections are identified by a hash of their source. A cached render is
+    only reused if its headings get the same slugs they had before, as slugs
+    depend on the headings of previous sections.
+
+    :param sections:
+        A list with the source of each page section, as returned by
+        :func:`get_page_sections`.
+    :param environ:
+        A dictionary with the parsing environment, as returned by
+        :func:`get_page_environ`. The paths of linked pages are stored as a
+        list in ``environ['links']``.
+    :param area:
+        The area of the page.
+    :param cache:
+        The section cache returned when the page was parsed before, or
+        ``None``.
+    :param cached_body:
+        The body returned when the page was parsed before, or ``None``.
+    :return:
+        A tuple ``(body, toc, cache)`` with the rendered body, the table of
+        contents and the section cache, a list with a tuple ``(hash, length,
+        toc, links, base_slugs, slugs)`` for each section.
+    """
+    cached = {}
+    if cache and cached_body is not None:
+        offset = 0
+        for entry in cache:
+            length = entry[1]
+            cached.setdefault(entry[0],
+                (cached_body[offset:offset + length],) + tuple(entry[2:]))
+            offset += length
+
+    headings = environ.setdefault('headings', [])
+    toc = environ.setdefault('toc', [])
+    links = environ.setdefault('links', [])
+
+    parts = []
+    new_cache = []
+    for source in sections:
+        section_hash = hashlib.md5(source.encode('utf-8')).hexdigest()
+        entry = cached.get(section_hash)
+        if entry is not None and get_unique_slugs(entry[3], headings) == \
+            entry[4]:
+            html, section_toc, section_links, base_slugs, slugs = entry
+            headings.extend(slugs)
+        else:
+            count = len(headings)
+            section_environ = {'headings': headings}
+            html = parse_page(source, section_environ, area)[0]
+            section_toc = section_environ.get('toc', [])
+            section_links = section_environ['links']
+            base_slugs = section_environ.get('base_slugs', [])
+            slugs = headings[count:]
+
+        toc.extend(section_toc)
+        links.extend(path for path in section_links if path not in links)
+        parts.append(html)
+        new_cache.append((section_hash, len(html), section_toc, section_links,
+            base_slugs, slugs))
+
+    return u''.join(parts), get_toc(toc), new_cache
+
+
 heading_re = re.compile(heading_re_string(), re.MULTILINE)
+block_macro_re = re.compile(r'^<<([a-zA-Z][\w-]*)[^>]*(?<!/)>>')
+block_macro_end_re = re.compile(r'<</([a-zA-Z][\w-]*)>>')
+
+HEADING_TAGS = ['h1','h2','h3','h4','h5','h6']
+DIALECT_OPTIONS = {
+    'macro_func': parse_macro,
+}
+
+#: Parsers shared by all requests in this instance.
+parser_pool = ParserPool()
+parser_pool.release(WikiParser())
 
-dialect = creoleparser.create_dialect(
-    creoleparser.dialects.creole11_base,
-    #wiki_links_path_func=create_wiki_link,
-    macro_func=parse_macro,
-)
-dialect.headings = Heading(['h1','h2','h3','h4','h5','h6'], '=')
-wiki_parser = creoleparser.Parser(dialect=dialect, encoding=None)
+_fingerprint = None
 
 MACROS = {
     'code':    macro_code,
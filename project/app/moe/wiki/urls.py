@@ -15,6 +15,8 @@
         /wiki/pages/changes-feed/
         /wiki/pages/changes-feed/<path:page_path>
 
+        /wiki/pages/backlinks/<path:page_path>
+
         /wiki/pages/diff/
         /wiki/pages/diff/<path:page_path>
 
@@ -66,6 +68,8 @@ def get_rules():
             Rule('/changes-atom', endpoint='wiki/changes-atom', handler='moe.wiki.handlers.WikiChangesFeedHandler', **kwargs),
             # Lists all changes for a given page (Atom format).
             Rule('/changes-atom/<path:page_path>', endpoint='wiki/changes-atom', handler='moe.wiki.handlers.WikiPageChangesFeedHandler', **kwargs),
+            # Lists all pages linking to a given page.
+            Rule('/backlinks/<path:page_path>', endpoint='wiki/backlinks', handler='moe.wiki.handlers.WikiBacklinksHandler', **kwargs),
             # Edition overview.
             Rule('/edit/', endpoint='wiki/edit', handler='moe.wiki.handlers.WikiEditOverviewHandler', **kwargs),
             # Edits a page.
@@ -74,8 +78,12 @@ def get_rules():
             Rule('/diff/', endpoint='wiki/diff', handler='moe.wiki.handlers.WikiDiffOverviewHandler', **kwargs),
             # Show diffs for a page revision.
             Rule('/diff/<path:page_path>', endpoint='wiki/diff', handler='moe.wiki.handlers.WikiDiffHandler', **kwargs),
-            # Reparse all pages.
+            # Reparse outdated pages; GET with ?job=<id> shows the progress.
             # Rule('/reparse/', endpoint='wiki/reparse', handler='moe.wiki.handlers.WikiReparseHandler', **kwargs),
+            # Convert page histories to the configured history storage.
+            # Rule('/migrate-history/', endpoint='wiki/migrate-history', handler='moe.wiki.handlers.WikiHistoryMigrationHandler', **kwargs),
+            # Compress the text of revisions saved uncompressed.
+            # Rule('/migrate-compression/', endpoint='wiki/migrate-compression', handler='moe.wiki.handlers.WikiCompressionMigrationHandler', **kwargs),
         ]),
         # A wiki page.
         Rule('/<path:page_path>', endpoint='wiki/index', handler='moe.wiki.handlers.WikiViewHandler', **kwargs),
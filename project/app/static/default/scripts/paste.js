@@ -29,4 +29,52 @@ $(document).ready(function() {
         }
       }
     });
+
+    /* progressive loading of large pastes: the next block is loaded when
+       the end of the loaded code gets close to the viewport */
+    var more = $('#paste-more'), loading = false;
+    function load_next_block() {
+      var url = more.attr('data-url');
+      if (loading || !url) {
+        return;
+      }
+      loading = true;
+      $.getJSON(url, function(data) {
+        more.before(data.html);
+        if (data.next) {
+          more.attr('data-url', data.next);
+        }
+        else {
+          more.remove();
+          more = $([]);
+        }
+        loading = false;
+        check_viewport();
+      });
+    }
+    function check_viewport() {
+      if (more.length && more.offset().top <
+          $(window).scrollTop() + 2 * $(window).height()) {
+        load_next_block();
+      }
+    }
+    if (more.length) {
+      more.find('a').click(function(e) {
+        e.preventDefault();
+        load_next_block();
+      });
+      $(window).scroll(check_viewport).resize(check_viewport);
+      check_viewport();
+    }
+
+    /* the edit form of large pastes gets the code only when opened */
+    $('#paste-edit a').click(function(e) {
+      var link = $(this);
+      e.preventDefault();
+      $.get(link.attr('href'), function(code) {
+        $('#code').val(code);
+        link.parent().remove();
+        $('form.lazy-edit').show();
+      }, 'text');
+    });
 });
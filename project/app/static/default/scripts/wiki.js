@@ -10,7 +10,8 @@ jQuery(function($) {
     $.tipfy.wiki.set_edit_section = function(url, text, title) {
         var match = url.search(/\?/);
         url += match == -1 ? '?' : '&';
-        $('.heading').each(function(i, val) {
+        // Headings in notes don't start sections.
+        $('.heading').not('.macro-note .heading').each(function(i, val) {
             var link = '<a class="editsectionlink" href="' + url + 'section='
                 + i + '" title="' + title + '">' + text + '</a>',
                 feedlink = $('.feedlink:first', this);
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    build_stylesheets
+    ~~~~~~~~~~~~~~~~~
+
+    Generates the CSS of all Pygments styles as static files with a content
+    hash in their names, and the moe.paste.stylesheets module that maps style
+    names to those files. The generated files are committed: run it again
+    after changing the Pygments version in versions.cfg, from the project
+    directory:
+
+        bin/python scripts/build_stylesheets.py
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'app')
+
+sys.path[0:0] = [APP_DIR, os.path.join(APP_DIR, 'lib'),
+    os.path.join(APP_DIR, 'distlib')]
+
+STYLESHEETS_DIR = os.path.join(APP_DIR, 'static', 'default', 'styles',
+    'pygments')
+
+
+def main():
+    from moe.paste.highlighting import build_stylesheets
+
+    # Remove stylesheets from previous builds.
+    if os.path.isdir(STYLESHEETS_DIR):
+        for filename in os.listdir(STYLESHEETS_DIR):
+            if filename.endswith('.css'):
+                os.remove(os.path.join(STYLESHEETS_DIR, filename))
+
+    stylesheets = build_stylesheets(STYLESHEETS_DIR)
+    for style_name, filename in sorted(stylesheets.items()):
+        print '%-20s %s' % (style_name, filename)
+
+
+if __name__ == '__main__':
+    main()